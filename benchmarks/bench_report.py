@@ -0,0 +1,80 @@
+"""
+Compare the per-job report walk with the columnar report builder on synthetic jobs.
+
+    python benchmarks/bench_report.py --jobs 10000 100000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from domaudit.project_audit.job_audit import generate_job_report
+from domaudit.project_audit import report_builder
+
+DOMINO_HOST = "https://domino.example.com"
+GOALS = {f"goal-{i}": f"Goal {i}" for i in range(5)}
+
+
+def make_job(i):
+    """
+    A job shaped like the merged output of get_job_data_async
+    """
+    submitted = 1700000000000 + i * 1000
+    return {
+        "id": f"job-{i}",
+        "number": i,
+        "jobRunCommand": f"python train.py --seed {i}",
+        "hardwareTier": "small-k8s",
+        "startedBy": {"username": f"user-{i % 50}"},
+        "statuses": {"executionStatus": "Succeeded", "isCompleted": True, "isArchived": False, "isScheduled": i % 10 == 0},
+        "stageTime": {"submissionTime": submitted, "runStartTime": submitted + 500 if i % 3 else None, "completedTime": submitted + 9000},
+        "environment": {"environmentName": "Domino Standard Environment", "revisionNumber": 7},
+        "goalIds": [f"goal-{i % 5}"] if i % 4 == 0 else [],
+        "endState": {"commitId": f"{i:040x}"},
+        "commitDetails": {"inputCommitId": f"{i + 1:040x}"},
+        "comments": [{"commenter": {"username": "reviewer"}, "created": submitted + 60000, "commentBody": {"value": "LGTM"}}] if i % 5 == 0 else [],
+        "dependentRepositories": [{"uri": "https://git.example.com/repo.git", "startingBranch": "main",
+                                   "startingCommitId": "abc", "startingCommitUri": "https://git.example.com/c/abc"}],
+        "dependentDatasetMounts": [{"datasetName": "training-data", "snapshotVersion": 3}],
+        "dependentExternalVolumeMounts": [],
+    }
+
+
+def per_job_report(jobs):
+    return {job: generate_job_report(jobs[job], GOALS, "project", "owner", "project-id", True, DOMINO_HOST) for job in jobs}
+
+
+def columnar_report(jobs):
+    job_ids, columns = report_builder.build_report_columns(jobs, GOALS, "project", "owner", "project-id", True, DOMINO_HOST)
+    return report_builder.columns_to_dict(job_ids, columns)
+
+
+def best_of(fn, jobs, repeat):
+    timings = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = fn(jobs)
+        timings.append(time.perf_counter() - t)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark project audit report generation")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[10000, 100000], help="Job counts to benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement, the fastest is reported")
+    args = parser.parse_args()
+
+    print(f"{'jobs':>8} {'per-job (s)':>12} {'columnar (s)':>13} {'speed-up':>9}")
+    for count in args.jobs:
+        jobs = {f"job-{i}": make_job(i) for i in range(count)}
+        per_job_time, expected = best_of(per_job_report, jobs, args.repeat)
+        columnar_time, actual = best_of(columnar_report, jobs, args.repeat)
+        if actual != expected:
+            raise SystemExit(f"Columnar report differs from the per-job report at {count} jobs")
+        print(f"{count:>8} {per_job_time:>12.3f} {columnar_time:>13.3f} {per_job_time / columnar_time:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Benchmark the domaudit service end to end against the local mock of Domino and Keycloak.
+
+    python benchmarks/bench_service.py --records 1000 10000 100000 --output results.json
+    python benchmarks/bench_service.py --records 10000 --latency-ms 20 --error-rate 0.01 --baseline results.json
+    python benchmarks/bench_service.py --records 1000 --projects 50 --audits project_audit_batch
+
+For each record count a mock is started, and for each audit a fresh service process is started
+against it, so peak RSS is that of a single audit. The service runs on the Flask development
+server in one process, rather than under gunicorn. Each run reports wall time, rows per second,
+response size, the service's peak RSS and the calls the mock received. Results are written as JSON
+with the settings and commit they were measured with, and --baseline prints the change from an earlier file.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
+
+import mock_domino
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+AUDITS = ("project_audit", "project_activity", "user_audit", "project_audit_batch")
+# The batch audit covers every mock project, so it is only run when asked for
+DEFAULT_AUDITS = AUDITS[:3]
+STARTUP_TIMEOUT_SECONDS = 30
+
+SERVICE_SCRIPT = """
+import sys
+from domaudit.domaudit import create_app
+create_app().run(host="127.0.0.1", port=int(sys.argv[1]), threaded=True)
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url, process):
+    deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"{url} exited during startup with code {process.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise SystemExit(f"{url} did not start within {STARTUP_TIMEOUT_SECONDS} seconds")
+
+
+def peak_rss_mb(pid):
+    """
+    Returns the peak resident set size of a process in MB, or None where /proc is not available
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except FileNotFoundError:
+        return None
+    return None
+
+
+def audit_request(audit, records, args):
+    """
+    Returns the path and parameters that read every record of an audit from the mock
+    """
+    if audit == "project_audit":
+        return "/project_audit", {"project_id": mock_domino.PROJECT_ID, "project_name": mock_domino.PROJECT_NAME,
+                                  "project_owner": mock_domino.PROJECT_OWNER, "all_pages": "true",
+                                  "page_size": args.page_size, "thread_count": args.thread_count, "format": args.format}
+    if audit == "project_activity":
+        oldest = (mock_domino.LATEST_TIME - records * mock_domino.ACTIVITY_INTERVAL_MS) / 1000
+        from_date = datetime.datetime.fromtimestamp(oldest, tz=datetime.timezone.utc) - datetime.timedelta(days=1)
+        return "/project_activity", {"project_id": mock_domino.PROJECT_ID, "page_size": args.page_size,
+                                     "from_date": from_date.strftime("%Y-%m-%d"), "max_pages": records, "format": args.format}
+    if audit == "project_audit_batch":
+        return "/project_audit_batch", {"owner": mock_domino.PROJECT_OWNER, "page_size": args.page_size,
+                                        "thread_count": args.thread_count, "format": "ndjson"}
+    date_from, date_to = mock_domino.event_date_range()
+    return "/user_audit", {"dateFrom": date_from, "dateTo": date_to, "format": args.format}
+
+
+def count_rows(response, output_format):
+    if output_format == "ndjson":
+        return sum(1 for line in response.content.splitlines()
+                   if line and not line.startswith((b'{"cursor"', b'{"summary"', b'{"timing"')))
+    if output_format == "json":
+        return len(response.json())
+    if output_format == "parquet":
+        return pq.read_metadata(pa.BufferReader(response.content)).num_rows
+    return pa.ipc.open_file(pa.BufferReader(response.content)).read_all().num_rows
+
+
+def run_audit(audit, records, mock_url, args):
+    port = free_port()
+    env = {**os.environ,
+           "DOMINO_API_HOST": mock_url,
+           "KEYCLOAK_HOST": mock_url.split("://", 1)[1],
+           "KEYCLOAK_PASSWORD": "benchmark",
+           "LOG_LEVEL": "WARNING",
+           "PYTHONPATH": REPO_ROOT}
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    service = subprocess.Popen([sys.executable, "-c", SERVICE_SCRIPT, str(port)], env=env, cwd=REPO_ROOT,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        service_url = f"http://127.0.0.1:{port}"
+        wait_until_up(f"{service_url}/endpoints", service)
+        requests.post(f"{mock_url}{mock_domino.RESET_PATH}")
+        path, params = audit_request(audit, records, args)
+
+        t = time.perf_counter()
+        response = requests.get(f"{service_url}{path}", params=params, headers={"X-Domino-Api-Key": "benchmark"})
+        elapsed = time.perf_counter() - t
+        output_format = params.get("format", args.format)
+        rows = count_rows(response, output_format) if response.status_code == 200 else None
+        calls = requests.get(f"{mock_url}{mock_domino.STATS_PATH}").json()
+        return {
+            "audit": audit,
+            "records": records,
+            "status": response.status_code,
+            "seconds": round(elapsed, 3),
+            "rows": rows,
+            "rows_per_second": round(rows / elapsed, 1) if rows else None,
+            "response_mb": round(len(response.content) / 1024 / 1024, 2),
+            "peak_rss_mb": peak_rss_mb(service.pid),
+            "upstream_calls": calls["total_calls"],
+            "upstream_errors": sum(calls["errors"].values()),
+            "calls_by_endpoint": calls["calls"],
+        }
+    finally:
+        service.terminate()
+        service.wait()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline):
+    previous = {(r["audit"], r["records"]): r for r in baseline.get("results", [])} if baseline else {}
+    print(f"{'audit':<17} {'records':>8} {'status':>6} {'seconds':>8} {'rows/s':>10} {'peak RSS MB':>12} {'calls':>8} {'errors':>7}"
+          + (f" {'speed-up':>9}" if baseline else ""))
+    for r in results:
+        line = (f"{r['audit']:<17} {r['records']:>8} {r['status']:>6} {r['seconds']:>8.2f} {r['rows_per_second'] or 0:>10.0f} "
+                f"{r['peak_rss_mb'] or 0:>12.1f} {r['upstream_calls']:>8} {r['upstream_errors']:>7}")
+        before = previous.get((r["audit"], r["records"]), None)
+        if before:
+            line += f" {before['seconds'] / r['seconds']:>8.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark domaudit audits against a mock Domino and Keycloak")
+    parser.add_argument("--records", type=int, nargs="+", default=[1000, 10000, 100000], help="Record counts to benchmark")
+    parser.add_argument("--audits", nargs="+", choices=AUDITS, default=list(DEFAULT_AUDITS),
+                        help="Audits to run, default all but project_audit_batch")
+    parser.add_argument("--format", default="json", choices=("json", "ndjson", "parquet", "arrow"), help="Report format, default json")
+    parser.add_argument("--page-size", type=int, default=1000, help="Page size of job and activity listings, default 1000")
+    parser.add_argument("--thread-count", type=int, default=10, help="Project audit thread_count, default 10")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Results file from an earlier run to compare against")
+    mock_domino.add_arguments(parser)
+    args = parser.parse_args()
+
+    settings = {name: value for name, value in vars(args).items() if name not in ("output", "baseline")}
+    results = []
+    for records in args.records:
+        mock_port = free_port()
+        mock = subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, "benchmarks", "mock_domino.py"),
+                                 "--port", str(mock_port), "--records", str(records),
+                                 "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+                                 "--projects", str(args.projects), "--error-rate", str(args.error_rate), "--error-status", str(args.error_status),
+                                 "--payload-bytes", str(args.payload_bytes), "--seed", str(args.seed)])
+        try:
+            mock_url = f"http://127.0.0.1:{mock_port}"
+            wait_until_up(f"{mock_url}{mock_domino.STATS_PATH}", mock)
+            for audit in args.audits:
+                results.append(run_audit(audit, records, mock_url, args))
+                print(f"{audit} with {records} records: {results[-1]['seconds']} seconds", file=sys.stderr)
+        finally:
+            mock.terminate()
+            mock.wait()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"commit": git_commit(), "python": platform.python_version(), "settings": settings,
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+"""
+Local mock of the Nucleus and Keycloak admin endpoints used by domaudit, for benchmarking.
+
+    python benchmarks/mock_domino.py --port 18080 --records 10000 --latency-ms 5 --error-rate 0.01
+
+Each of --projects projects holds --records jobs, the first project holds --records activity
+events, and Keycloak holds --records user events spread over EVENT_DAYS days. Every response
+is delayed by --latency-ms plus up to --jitter-ms, a fraction --error-rate of calls fail with
+--error-status, and --payload-bytes of padding is added to each job, activity and event.
+Latency and errors come from a seeded random generator, so the same settings give the same run.
+
+GET /_stats returns the calls made to each endpoint template, and POST /_reset clears them.
+"""
+import argparse
+import asyncio
+import bisect
+import datetime
+import random
+
+from aiohttp import web
+
+PROJECT_ID = "benchmark-project"
+PROJECT_OWNER = "benchmark-owner"
+PROJECT_NAME = "benchmark"
+# Newest activity, user event and job submission time, in epoch milliseconds
+LATEST_TIME = int(datetime.datetime(2024, 1, 31, tzinfo=datetime.timezone.utc).timestamp() * 1000)
+ACTIVITY_INTERVAL_MS = 60 * 1000
+EVENT_DAYS = 10
+KEYCLOAK_USERS = 100
+# Fields of each job included in the job listing
+LISTING_FIELDS = ("id", "number", "jobRunCommand", "startedBy", "statuses", "stageTime")
+GOALS = [{"id": f"goal-{i}", "title": f"Goal {i}"} for i in range(5)]
+
+STATS_PATH = "/_stats"
+RESET_PATH = "/_reset"
+
+
+def project_id(k):
+    return PROJECT_ID if k == 0 else f"{PROJECT_ID}-{k}"
+
+
+def project_name(k):
+    return PROJECT_NAME if k == 0 else f"{PROJECT_NAME}-{k}"
+
+
+def project_job_id(k, i):
+    # Job IDs are unique across projects, as in Domino
+    return f"job-{i}" if k == 0 else f"job-{k}-{i}"
+
+
+def make_job(i, padding, job_id=None):
+    submitted = LATEST_TIME - i * 1000
+    return {
+        "id": job_id or f"job-{i}",
+        "number": i,
+        "jobRunCommand": f"python train.py --seed {i}",
+        "hardwareTier": "small-k8s",
+        "startedBy": {"username": f"user-{i % KEYCLOAK_USERS}"},
+        "statuses": {"executionStatus": "Failed" if i % 7 == 0 else "Succeeded", "isCompleted": True, "isArchived": False, "isScheduled": i % 10 == 0},
+        "stageTime": {"submissionTime": submitted, "runStartTime": submitted + 500 if i % 3 else None,
+                      "completedTime": submitted + 9000},
+        "environment": {"environmentName": "Domino Standard Environment", "revisionNumber": 7},
+        "goalIds": [f"goal-{i % 5}"] if i % 4 == 0 else [],
+        "endState": {"commitId": f"{i:040x}"},
+        "commitDetails": {"inputCommitId": f"{i + 1:040x}"},
+        "padding": padding,
+    }
+
+
+class MockDomino:
+    """
+    Generates the mock's data on request from record indices, so large record counts cost little memory
+    """
+
+    def __init__(self, records, projects=1, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, error_status=503, payload_bytes=0, seed=0):
+        self.records = records
+        self.projects = {project_id(k): k for k in range(projects)}
+        self.project_names = {project_name(k): k for k in range(projects)}
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.padding = "x" * payload_bytes
+        self.random = random.Random(seed)
+        self.calls = {}
+        self.errors = {}
+        # Oldest first, so bisect can find the events in a time range
+        event_interval = EVENT_DAYS * 86400 * 1000 // max(records, 1)
+        self.event_times = [LATEST_TIME - (records - 1 - i) * event_interval for i in range(records)]
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        if request.path in (STATS_PATH, RESET_PATH):
+            return await handler(request)
+        route = request.match_info.route.resource
+        endpoint = route.canonical if route is not None else "unmatched"
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            return web.Response(status=self.error_status, headers={"Retry-After": "0"})
+        return await handler(request)
+
+    async def stats(self, request):
+        return web.json_response({"calls": self.calls, "errors": self.errors, "total_calls": sum(self.calls.values())})
+
+    async def reset(self, request):
+        self.calls.clear()
+        self.errors.clear()
+        return web.json_response({})
+
+    async def principal(self, request):
+        return web.json_response({"isAnonymous": False, "isAdmin": True, "canonicalName": "benchmark"})
+
+    async def user_self(self, request):
+        return web.json_response({"userName": "benchmark", "email": "benchmark@example.com", "fullName": "Benchmark"})
+
+    def project_json(self, k):
+        return {"id": project_id(k), "name": project_name(k), "ownerUsername": PROJECT_OWNER}
+
+    async def projects_list(self, request):
+        return web.json_response([self.project_json(k) for k in self.projects.values()])
+
+    async def project(self, request):
+        k = self.projects.get(request.match_info["project_id"], None)
+        if k is None:
+            return web.json_response({"message": "Project not found"}, status=404)
+        return web.json_response(self.project_json(k))
+
+    async def find_project(self, request):
+        k = self.project_names.get(request.query.get("projectName", None), None)
+        if k is None or request.query.get("ownerName", None) != PROJECT_OWNER:
+            return web.json_response({"message": "Project not found"}, status=404)
+        return web.json_response(self.project_json(k))
+
+    async def goals(self, request):
+        return web.json_response(GOALS)
+
+    async def install_config(self, request):
+        return web.json_response({"host": "https://domino.example.com"})
+
+    async def jobs(self, request):
+        k = self.projects.get(request.query.get("projectId", None), None)
+        if k is None:
+            return web.json_response({"message": "Project not found"}, status=404)
+        page_size = int(request.query.get("page_size", 500))
+        first = (int(request.query.get("page_no", 1)) - 1) * page_size
+        # Like Domino, the listing carries a summary of each job, enough to filter on
+        return web.json_response({"jobs": [{name: job[name] for name in LISTING_FIELDS}
+                                           for job in (make_job(i, "", project_job_id(k, i))
+                                                       for i in range(first, min(first + page_size, self.records)))]})
+
+    async def job(self, request):
+        job = request.match_info["job_id"]
+        return web.json_response(make_job(int(job.split("-")[-1]), self.padding, job))
+
+    async def runtime_execution_details(self, request):
+        return web.json_response({"dependentDatasetMounts": [{"datasetName": "training-data", "snapshotVersion": 3}],
+                                  "dependentExternalVolumeMounts": []})
+
+    async def comments(self, request):
+        return web.json_response({"comments": [{"commenter": {"username": "reviewer"}, "created": LATEST_TIME,
+                                                "commentBody": {"value": "LGTM"}}]})
+
+    async def artifacts_info(self, request):
+        return web.json_response({})
+
+    async def code_info(self, request):
+        return web.json_response({"dependentRepositories": [{"uri": "https://git.example.com/repo.git", "startingBranch": "main",
+                                                             "startingCommitId": "abc", "startingCommitUri": None}]})
+
+    async def activity(self, request):
+        page_size = int(request.query.get("pageSize", 500))
+        latest = int(request.query.get("latestTimeStamp", LATEST_TIME))
+        # Activity i happened i minutes before LATEST_TIME, newest first
+        first = max(0, -(-(LATEST_TIME - latest) // ACTIVITY_INTERVAL_MS))
+        return web.json_response({"activity": [{
+            "id": f"activity-{i}",
+            "timestamp": LATEST_TIME - i * ACTIVITY_INTERVAL_MS,
+            "activity": "Job completed",
+            "activitySource": "job",
+            "activityBy": {"username": f"user-{i % KEYCLOAK_USERS}"},
+            "metadata": {"data": {"currentStatus": "Succeeded", "padding": self.padding}},
+        } for i in range(first, min(first + page_size, self.records))]})
+
+    async def keycloak_token(self, request):
+        return web.json_response({"access_token": "benchmark", "refresh_token": "benchmark", "expires_in": 3600,
+                                  "refresh_expires_in": 3600, "token_type": "Bearer"})
+
+    async def keycloak_users(self, request):
+        first = int(request.query.get("first", 0))
+        last = min(first + int(request.query.get("max", 100)), KEYCLOAK_USERS)
+        return web.json_response([{"id": f"kc-{i}", "username": f"user-{i}", "email": f"user-{i}@example.com"}
+                                  for i in range(first, last)])
+
+    async def keycloak_events(self, request):
+        query = request.query
+        lo, hi = 0, len(self.event_times)
+        if "dateFrom" in query:
+            day = datetime.datetime.strptime(query["dateFrom"], "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
+            lo = bisect.bisect_left(self.event_times, day.timestamp() * 1000)
+        if "dateTo" in query:
+            day = datetime.datetime.strptime(query["dateTo"], "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
+            hi = bisect.bisect_left(self.event_times, (day + datetime.timedelta(days=1)).timestamp() * 1000)
+        # Keycloak returns the newest events first
+        first = hi - 1 - int(query.get("first", 0))
+        last = max(first - int(query.get("max", 100)), lo - 1)
+        return web.json_response([{"time": self.event_times[i], "type": "LOGIN", "userId": f"kc-{i % KEYCLOAK_USERS}",
+                                   "ipAddress": "10.0.0.1", "details": {"padding": self.padding}}
+                                  for i in range(first, last, -1)])
+
+    def app(self):
+        app = web.Application(middlewares=[self.middleware])
+        routes = [
+            ("/v4/auth/principal", self.principal),
+            ("/v4/users/self", self.user_self),
+            ("/v4/projects", self.projects_list),
+            ("/v4/projects/{project_id}", self.project),
+            ("/v4/gateway/projects/findProjectByOwnerAndName", self.find_project),
+            ("/v4/projectManagement/{project_id}/goals", self.goals),
+            ("/currentInstallConfig", self.install_config),
+            ("/v4/jobs", self.jobs),
+            ("/v4/jobs/{job_id}", self.job),
+            ("/v4/jobs/{job_id}/runtimeExecutionDetails", self.runtime_execution_details),
+            ("/v4/jobs/{job_id}/comments", self.comments),
+            ("/v4/jobs/job/{job_id}/artifactsInfo", self.artifacts_info),
+            ("/v4/jobs/project/{project_id}/codeInfo/{job_id}", self.code_info),
+            ("/v4/activity", self.activity),
+            ("/auth/admin/realms/DominoRealm/users", self.keycloak_users),
+            ("/auth/admin/realms/DominoRealm/events", self.keycloak_events),
+            (STATS_PATH, self.stats),
+        ]
+        for path, handler in routes:
+            app.router.add_get(path, handler)
+        app.router.add_post("/auth/realms/master/protocol/openid-connect/token", self.keycloak_token)
+        app.router.add_post(RESET_PATH, self.reset)
+        return app
+
+
+def event_date_range():
+    """
+    Returns the first and last day holding user events, as yyyy-MM-dd
+    """
+    last_day = datetime.datetime.fromtimestamp(LATEST_TIME / 1000, tz=datetime.timezone.utc)
+    first_day = last_day - datetime.timedelta(days=EVENT_DAYS)
+    return first_day.strftime("%Y-%m-%d"), last_day.strftime("%Y-%m-%d")
+
+
+def add_arguments(parser):
+    parser.add_argument("--projects", type=int, default=1, help="Projects owned by PROJECT_OWNER, default 1")
+    parser.add_argument("--latency-ms", type=float, default=5, help="Delay added to every response, default 5")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Random extra delay of up to this much, default 0")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of calls that fail, default 0")
+    parser.add_argument("--error-status", type=int, default=503, help="Status returned by failed calls, default 503")
+    parser.add_argument("--payload-bytes", type=int, default=0, help="Padding added to each job, activity and event, default 0")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for latency jitter and errors, default 0")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Domino and Keycloak APIs for benchmarking domaudit")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--records", type=int, default=1000, help="Jobs per project, activity events and user events to serve, default 1000")
+    add_arguments(parser)
+    args = parser.parse_args()
+    mock = MockDomino(args.records, args.projects, args.latency_ms, args.jitter_ms, args.error_rate, args.error_status,
+                      args.payload_bytes, args.seed)
+    web.run_app(mock.app(), host="127.0.0.1", port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,40 @@
 import json
 import sys
 import os
+import time
 import logging
 
-from flask import Flask, request, Response, make_response
+from flask import Flask, request, Response, make_response, send_file
 from flask_healthz import Healthz
-import requests
-from domaudit.services import constants
+from domaudit.services import constants, http_client, cache, retry, audit_jobs, metrics, timing, event_loop
 from domaudit import FLASK_APP_NAME
 from functools import wraps, partial
 from domaudit.user_audit.user_audit import get_user_events
-from domaudit.project_audit import job_audit
+from domaudit.project_audit import job_audit, batch_audit, sharding
 
 constants.DOMINO_API_HOST = os.getenv("DOMINO_API_HOST", default="http://nucleus-frontend.domino-platform:80")
 
+# Resolved principals, keyed by a hash of the caller's credentials
+principal_cache = cache.TTLCache("principal",
+                                 max_size=int(os.getenv("AUTH_CACHE_MAX_SIZE", 1024)),
+                                 ttl=float(os.getenv("AUTH_CACHE_TTL_SECONDS", 60)))
+
+
+async def fetch_principal(auth_header):
+    """
+    Returns the status and body of the whoami call for the caller's credentials, then of the users/self call.
+    users/self is only called for a signed in user, and its status is None otherwise.
+    """
+    async with http_client.async_session(auth_header, 1) as session:
+        status, user = await http_client.get_json_async(session, f"{constants.DOMINO_API_HOST}/{constants.WHO_AM_I_ENDPOINT}",
+                                                        endpoint=constants.WHO_AM_I_ENDPOINT)
+        if status != 200 or user["isAnonymous"]:
+            return status, user, None, None
+        self_status, user_self = await http_client.get_json_async(session, f"{constants.DOMINO_API_HOST}/{constants.USER_ENDPOINT}",
+                                                                  endpoint=constants.USER_ENDPOINT)
+    return status, user, self_status, user_self
+
+
 ENDPOINTS = [
     {"description": "Log and metadata of all project executions", "name": "Project Audit", "endpoint": "/project_audit", "admin": False},
     {"description": "Output of all Project Activity events", "name": "Project Activity", "endpoint": "/project_activity", "admin": False},
@@ -48,6 +69,29 @@ def create_app(test_config=None):
 
     Healthz(app, no_log=True)
 
+    @app.before_request
+    def start_timer():
+        request.started_at = time.monotonic()
+        # debug_timing=true returns a breakdown of where the request spent its time
+        timing.start(request.args.get("debug_timing", "False").lower() == "true")
+
+    @app.after_request
+    def record_request(response):
+        started_at = getattr(request, "started_at", None)
+        if started_at is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            metrics.REQUEST_LATENCY.labels(route, request.method, str(response.status_code)).observe(time.monotonic() - started_at)
+        # Streamed responses have sent their headers by the time the timings are known, and end with a trailer line instead
+        timer = timing.current()
+        if timer is not None and not response.is_streamed:
+            response.headers.update(timer.headers())
+            logging.info(f"{request.path} timing: {response.headers[timing.TIMING_HEADER]}")
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def prometheus_metrics(**kwargs):
+        return metrics.metrics_response()
+
     logging.info("Starting up Field Audit API service")
     logging.info("Domino Nucleus URI=" + constants.DOMINO_API_HOST)
     
@@ -75,25 +119,36 @@ def create_app(test_config=None):
             else:
                 return Response("No Auth info provided, this endpoint requires authentication", 401)
 
-            user_response = requests.get(f"{constants.DOMINO_API_HOST}/{constants.WHO_AM_I_ENDPOINT}", headers=auth_header)
-            if not user_response.status_code == 200:
-                error = "Error getting user: {user_response.text}"
-                logging.error(error)
-                return Response(error, 500), {}, None
+            # Repeat callers skip the whoami and users/self lookups until the cache entry expires
+            with timing.phase("auth"):
+                cache_key = cache.credential_key(auth_header)
+                principal = principal_cache.get(cache_key)
+                if principal is None:
+                    # The lookups run on the worker's event loop, sharing its connections with the audits
+                    status, user, self_status, user_self = event_loop.run(fetch_principal(auth_header))
+                    if not status == 200:
+                        error = f"Error getting user: {status}"
+                        logging.error(error)
+                        return Response(error, 500)
 
-            user = user_response.json()
+                    if user["isAnonymous"]:
+                        warning = "Unable to authenticate user"
+                        logging.warning(warning)
+                        return Response(warning, 401)
 
-            if user["isAnonymous"]:
-                warning = "Unable to authenticate user"
-                logging.warning(warning)
-                return Response(warning, 401)
-            
+                    # Only a 200 response is parsed, as error bodies such as an ingress 502 page need not be JSON
+                    if not self_status == 200:
+                        error = f"Error getting user profile: {self_status}"
+                        logging.error(error)
+                        return Response(error, 500)
+                    principal = (user, user_self)
+                    principal_cache.set(cache_key, principal)
+
+            user, user_self = principal
             if is_admin and not user['isAdmin']:
                 warning = "Endpoint requires Admin Domino access"
                 logging.warning(warning)
                 return Response(warning, 401)
-            
-            user_self = requests.get(f"{constants.DOMINO_API_HOST}/{constants.USER_ENDPOINT}", headers=auth_header).json()
 
             return f(user_self, auth_header,*args, **kwargs)
         return authenticate
@@ -110,6 +165,22 @@ def create_app(test_config=None):
         
         return result
 
+    @app.route("/project_audit_batch", methods=["GET", "POST"])
+    @authenticate_user
+    def project_audit_batch(user, auth_header, **kwargs):
+        logging.info(f"Authenticated request for a batch project audit from {user.get('email', None)}")
+        requesting_user = user.get('userName', None)
+        # Long project lists can be sent as a JSON body instead of query args
+        args = {**request.args, **(request.get_json(silent=True) or {})}
+        return batch_audit.main(auth_header, requesting_user, args)
+
+    # Replicas coordinating a sharded audit send shards of it here. The caller's credentials come with each shard
+    @app.route(sharding.SHARD_PATH, methods=["POST"])
+    @authenticate_user
+    def project_audit_shard(user, auth_header, **kwargs):
+        requesting_user = user.get('userName', None)
+        return job_audit.shard_main(auth_header, requesting_user, request.get_json(silent=True) or {})
+
     @app.route("/project_activity", methods=["GET"])
     @authenticate_user
     def get_project_activity(user, auth_header,**kwargs):
@@ -119,6 +190,57 @@ def create_app(test_config=None):
         
         return result
 
+    @app.route("/audit_jobs", methods=["POST"])
+    @authenticate_user
+    def submit_audit_job(user, auth_header, **kwargs):
+        logging.info(f"Authenticated request to submit a background audit from {user.get('email', None)}")
+        if not audit_jobs.AUDIT_JOBS_ENABLED:
+            return make_response({"message": "Background audits are not enabled on this deployment"}, 404)
+        requesting_user = user.get('userName', None)
+        # Parameters are the same as the synchronous endpoint, as query args or a JSON body
+        args = {**request.args, **(request.get_json(silent=True) or {})}
+        audit = args.pop("audit", "project_audit")
+        if audit != "project_audit":
+            return make_response({"message": f"Unsupported audit: {audit}. Valid values: project_audit"}, 400)
+        args = {key: str(value) for key, value in args.items()}
+        settings, error = job_audit.audit_settings(args)
+        if error:
+            return error
+
+        job = audit_jobs.submit(audit, requesting_user, args, partial(job_audit.run_audit_job, auth_header, requesting_user, args))
+        response = make_response({**job.describe(),
+                                  "status_url": f"/audit_jobs/{job.id}",
+                                  "result_url": f"/audit_jobs/{job.id}/result"}, 202)
+        response.headers["Location"] = f"/audit_jobs/{job.id}"
+        return response
+
+    def find_audit_job(user, job_id):
+        # Other users' jobs are reported as missing, rather than forbidden
+        job = audit_jobs.get_job(job_id)
+        if job is None or job.status["owner"] != user.get('userName', None):
+            return None
+        return job
+
+    @app.route("/audit_jobs/<job_id>", methods=["GET"])
+    @authenticate_user
+    def get_audit_job(user, auth_header, job_id, **kwargs):
+        job = find_audit_job(user, job_id)
+        if job is None:
+            return make_response({"message": f"No audit job {job_id}"}, 404)
+        return make_response(job.describe())
+
+    @app.route("/audit_jobs/<job_id>/result", methods=["GET"])
+    @authenticate_user
+    def get_audit_job_result(user, auth_header, job_id, **kwargs):
+        job = find_audit_job(user, job_id)
+        if job is None:
+            return make_response({"message": f"No audit job {job_id}"}, 404)
+        if job.status["status"] != audit_jobs.SUCCEEDED:
+            return make_response({**job.describe(), "message": f"Audit job {job_id} is {job.status['status']}"}, 409)
+        result = job.status["result"]
+        return send_file(job.path(result["filename"]), mimetype=result["mimetype"],
+                         as_attachment=True, download_name=result["filename"])
+
     @app.route("/user_audit", methods=["GET"])
     @authenticate_admin_user
     def user_audit(user, auth_header,**kwargs):
@@ -127,6 +249,44 @@ def create_app(test_config=None):
         
         return get_user_events(request.args)
     
+    @app.route("/cache_stats", methods=["GET"])
+    @authenticate_admin_user
+    def get_cache_stats(user, auth_header, **kwargs):
+        logging.info(f"Authenticated Admin request for cache stats from {user.get('email', None)}")
+
+        return make_response(cache.cache_stats())
+
+    @app.route("/invalidate_cache", methods=["POST"])
+    @authenticate_admin_user
+    def invalidate_cache(user, auth_header, **kwargs):
+        # ?project_id= drops what is cached about one project, ?cache= empties one cache, and neither empties them all
+        logging.info(f"Authenticated Admin request to invalidate caches from {user.get('email', None)}: {dict(request.args)}")
+        project_id = request.args.get("project_id", None)
+        if project_id:
+            job_audit.invalidate_project_metadata(project_id)
+            return make_response({"invalidated_project": project_id})
+        name = request.args.get("cache", None)
+        if name and name not in cache.CACHES:
+            return make_response({"message": f"Unknown cache: {name}. Valid values: {', '.join(cache.CACHES)}"}, 400)
+        return make_response({"invalidated": cache.invalidate_caches(name)})
+
+    @app.route("/circuit_stats", methods=["GET"])
+    @authenticate_admin_user
+    def get_circuit_stats(user, auth_header, **kwargs):
+        logging.info(f"Authenticated Admin request for circuit breaker stats from {user.get('email', None)}")
+
+        return make_response(retry.breaker_stats())
+
+    @app.errorhandler(retry.UpstreamError)
+    def upstream_error(e):
+        # Domino API failures end the request, not the worker
+        logging.error(f"Request failed: {e}")
+        if isinstance(e, retry.CircuitOpenError):
+            return make_response({"message": str(e)}, 503, {"Retry-After": str(max(round(e.retry_after), 1))})
+        # Pass on client errors such as an unknown project, anything else is a bad gateway
+        status = e.status_code if e.status_code and 400 <= e.status_code < 500 and e.status_code != 429 else 502
+        return make_response({"message": str(e)}, status)
+
     @app.route("/endpoints", methods=["GET"])
     def domaudit_endpoints(**kwargs):
         logging.debug(f"######## [{request.method}]")
@@ -0,0 +1,242 @@
+import os
+import json
+import logging
+from collections import deque
+from urllib.parse import urlencode
+
+from flask import make_response, Response
+
+from domaudit.services import constants, http_client, retry, concurrency, metrics, timing
+from domaudit.project_audit import job_audit
+
+# Projects whose jobs are being enriched at once by a batch audit. The rest wait their turn
+BATCH_ACTIVE_PROJECTS = int(os.getenv("BATCH_ACTIVE_PROJECTS", 8))
+# Most projects a single batch audit may cover
+BATCH_MAX_PROJECTS = int(os.getenv("BATCH_MAX_PROJECTS", 5000))
+
+BATCH_USAGE = ("Usage: /project_audit_batch?projects=<owner>/<name>,<owner>/<name> "
+               "or ?project_ids=<project_id>,<project_id> or ?owner=<owner>")
+
+
+def split_list(value):
+    """
+    Returns the items of a comma separated query arg, or of a list given in a JSON body
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [item.strip() for item in value if item and item.strip()]
+
+
+def list_projects(auth_header):
+    """
+    Returns every project the caller can see
+    """
+    url = f"{job_audit.api_host}/{constants.GET_PROJECTS_ENDPOINT}"
+    result = http_client.get(url, headers=auth_header, endpoint=constants.GET_PROJECTS_ENDPOINT)
+    if result.status_code != 200:
+        job_audit.api_fail(result.status_code, "list_projects")
+    return result.json()
+
+
+def batch_projects(args, auth_header):
+    """
+    Returns the projects named by a batch request, each as a dictionary with whichever of
+    id, name and owner are already known, and an error response if the request is invalid
+    """
+    projects = []
+    for project in split_list(args.get("projects", None)):
+        owner, _, name = project.partition("/")
+        if not owner or not name:
+            return None, make_response({"message": f"Invalid project: {project}. Expected <owner>/<name>"}, 400)
+        projects.append({"id": None, "name": name, "owner": owner})
+    for project_id in split_list(args.get("project_ids", None)):
+        projects.append({"id": project_id, "name": None, "owner": None})
+    owner = args.get("owner", None)
+    if owner:
+        # Only projects the caller can see are listed, so the filter never reaches beyond their access
+        for project in list_projects(auth_header):
+            if project.get("ownerUsername", None) == owner:
+                projects.append({"id": project.get("id", None), "name": project.get("name", None), "owner": owner})
+
+    if not projects:
+        message = f"No projects owned by {owner} were found" if owner else BATCH_USAGE
+        return None, make_response({"message": message}, 400)
+
+    # Drop repeats now, and projects named both by ID and by owner/name once they are resolved
+    unique = {}
+    for project in projects:
+        key = project["id"] or (project["owner"], project["name"])
+        unique.setdefault(key, project)
+    projects = list(unique.values())
+    if len(projects) > BATCH_MAX_PROJECTS:
+        return None, make_response({"message": f"{len(projects)} projects requested, at most {BATCH_MAX_PROJECTS} are allowed"}, 400)
+    return projects, None
+
+
+def project_label(project):
+    return f"{project['owner']}/{project['name']}" if project["name"] else project["id"]
+
+
+async def get_api_json_async(url, endpoint, origin, session):
+    status, data = await http_client.get_json_async(session, url, endpoint=endpoint)
+    if status != 200:
+        job_audit.api_fail(status, origin)
+    return data
+
+
+async def resolve_project_async(project, session):
+    """
+    Fill in a project's ID, name and owner, whichever were not given, and fetch its goals
+    """
+    api_host = job_audit.api_host
+    if project["id"] is None:
+        key = (project["owner"], project["name"])
+        project["id"] = job_audit.project_id_cache.get(key, None)
+        if project["id"] is None:
+            query = urlencode({"ownerName": project["owner"], "projectName": project["name"]})
+            data = await get_api_json_async(f"{api_host}/{constants.GATEWAY_ENDPOINT}/projects/findProjectByOwnerAndName?{query}",
+                                            "v4/gateway/projects/findProjectByOwnerAndName", "resolve_project_async", session)
+            project["id"] = data.get("id", None)
+            # A project that was not found is skipped, and looked up again next time rather than cached
+            if project["id"] is None:
+                job_audit.api_fail(404, "resolve_project_async")
+            job_audit.project_id_cache.set(key, project["id"])
+    # Every project is read by ID, whether or not its name was given, so the caller is known to have access
+    # before cached goals are used
+    data = await get_api_json_async(f"{api_host}/{constants.GET_PROJECTS_ENDPOINT}/{project['id']}",
+                                    "v4/projects/{project_id}", "resolve_project_async", session)
+    project["name"] = data.get("name", None)
+    project["owner"] = data.get("ownerUsername", None)
+    job_audit.project_cache.set(project["id"], {"id": project["id"], "name": project["name"], "owner": project["owner"]})
+    goals = job_audit.goals_cache.get(project["id"], None)
+    if goals is None:
+        data = await get_api_json_async(f"{api_host}/{constants.PROJECTMANAGEMENT_ENDPOINT}/{project['id']}/goals",
+                                        "v4/projectManagement/{project_id}/goals", "resolve_project_async", session)
+        goals = job_audit.goal_titles(data)
+        job_audit.goals_cache.set(project["id"], goals)
+    project["goals"] = goals
+
+
+async def fair_job_pages(projects, page_size, session, job_projects, failed_projects, active_limit=BATCH_ACTIVE_PROJECTS):
+    """
+    Yield (project ID, job ID) pairs from many projects, for enrich_jobs.
+    Up to active_limit projects are listed at once, and each round takes one job from every
+    active project, so a project with many jobs cannot hold back the others. When a project
+    runs out of jobs the next one waiting takes its place.
+    job_projects is filled with the project of every job yielded. Projects that cannot be read
+    are skipped and added to failed_projects, unless the circuit to Nucleus is open.
+    """
+    waiting = deque(projects)
+    active = []
+    started = set()
+
+    def fail(project, error):
+        logging.warning(f"Skipping project {project_label(project)} in batch audit: {error}")
+        failed_projects.append({"project": project_label(project), "error": str(error)})
+
+    async def fill():
+        while waiting and len(active) < active_limit:
+            project = waiting.popleft()
+            try:
+                await resolve_project_async(project, session)
+            except retry.CircuitOpenError:
+                raise
+            except retry.UpstreamError as e:
+                fail(project, e)
+                continue
+            # A project named by ID and by owner/name is only known to be the same one once resolved
+            if project["id"] in started:
+                continue
+            started.add(project["id"])
+            pages = job_audit.iter_job_pages(project["id"], page_size, 1, session, all_pages=True)
+            active.append((project, pages, deque()))
+
+    try:
+        await fill()
+        while active:
+            jobs = []
+            for entry in list(active):
+                project, pages, job_ids = entry
+                if not job_ids:
+                    try:
+                        job_ids.extend(await pages.__anext__())
+                    except StopAsyncIteration:
+                        active.remove(entry)
+                        continue
+                    except retry.CircuitOpenError:
+                        raise
+                    except retry.UpstreamError as e:
+                        fail(project, e)
+                        active.remove(entry)
+                        continue
+                job_id = job_ids.popleft()
+                job_projects[job_id] = project
+                jobs.append((project["id"], job_id))
+            if jobs:
+                yield jobs
+            await fill()
+    finally:
+        for _, pages, _ in active:
+            await pages.aclose()
+
+
+async def stream_batch_job_data(projects, auth_header, threads, page_size, limiter, failed_projects):
+    """
+    Yield (project, job data) for every job in every project, enriched by one shared pool of workers
+    """
+    job_projects = {}
+    async with http_client.async_session(auth_header, threads, [limiter.observe]) as session:
+        job_pages = fair_job_pages(projects, page_size, session, job_projects, failed_projects)
+        async for job in job_audit.enrich_jobs(job_pages, auth_header, session, threads, limiter):
+            yield job_projects.pop(job.get("id", None)), job
+
+
+def stream_batch_report(batch_stream, projects, create_links, domino_host, failed_projects):
+    """
+    Yield the batch report as newline delimited JSON, one job per line with its project.
+    The last line summarises the projects audited and any that were skipped.
+    """
+    rows = 0
+    emitted = metrics.ROWS_EMITTED.labels("/project_audit_batch")
+    for project, job_data in batch_stream:
+        row = {"Project ID": project["id"], "Project Owner": project["owner"], "Job ID": job_data.get("id", None)}
+        row.update(job_audit.generate_job_report(job_data, project["goals"], project["name"], project["owner"],
+                                                 project["id"], create_links, domino_host))
+        rows += 1
+        emitted.inc()
+        yield json.dumps(row) + "\n"
+    logging.info(f"Batch audit streamed {rows} jobs from {len(projects)} projects requested, {len(failed_projects)} skipped")
+    yield json.dumps({"summary": {"projects_requested": len(projects), "jobs": rows, "failed_projects": failed_projects}}) + "\n"
+
+
+def main(auth_header, requesting_user, args):
+    """
+    Audit the jobs of many projects in one pipeline, streamed as newline delimited JSON
+    """
+    output_format = args.get("format", "ndjson").lower()
+    if output_format != "ndjson":
+        return make_response({"message": f"Unsupported format: {output_format}. Valid values: ndjson"}, 400)
+    create_links = str(args.get("links", "False")).lower() == "true"
+    numbers, error = job_audit.positive_int_args(args, {"page_size": 500,
+                                                        "thread_count": os.getenv("PROJECT_AUDIT_HTTP_THREAD_COUNT", 10)})
+    if error:
+        return make_response({"message": error}, 400)
+    page_size = numbers["page_size"]
+    threads = numbers["thread_count"]
+
+    with timing.phase("project_listing"):
+        projects, error = batch_projects(args, auth_header)
+    if error:
+        return error
+    logging.info(f"{requesting_user} requested a batch audit of {len(projects)} projects using up to {threads} thread(s)...")
+
+    with timing.phase("install_config"):
+        domino_host = job_audit.get_domino_host(auth_header)
+    limiter = concurrency.AdaptiveLimiter(threads)
+    failed_projects = []
+    batch_stream = timing.timed("enrichment", job_audit.iterate_async(
+        stream_batch_job_data(projects, auth_header, threads, page_size, limiter, failed_projects)))
+    report = stream_batch_report(batch_stream, projects, create_links, domino_host, failed_projects)
+    return Response(timing.with_trailer(report, "/project_audit_batch"), mimetype="application/x-ndjson")
@@ -1,22 +1,61 @@
 import os
+import json
+import base64
 import logging
-import requests
 import datetime
+import time
 import asyncio
-from aiohttp import ClientSession,TCPConnector
-from domaudit.services import constants
-from flask import make_response
+from domaudit.services import constants, http_client, formats, row_buffer, retry, concurrency, cache, metrics, timing, event_loop
+from domaudit.project_audit import job_store, report_builder, report_pool, sharding
+from flask import make_response, Response
 
 api_host = os.getenv('DOMINO_API_HOST')
 
+OUTPUT_FORMATS = ("json", "ndjson", *formats.COLUMNAR_FORMATS)
+ACTIVITY_FORMATS = ("json", "ndjson", *formats.COLUMNAR_FORMATS)
+# Most pages of activity read by one request before a cursor is returned instead
+ACTIVITY_MAX_PAGES = int(os.getenv("ACTIVITY_MAX_PAGES", 100))
+ACTIVITY_CURSOR_HEADER = "X-Domaudit-Cursor"
+ACTIVITY_COLUMNS = ("Activity", "Timestamp", "User", "Source", "Status", "CommitMessage", "Action", "Files Changed")
+# Number of newly completed jobs to collect before writing them to the job store
+JOB_STORE_BATCH_SIZE = 200
+REPORT_CACHE_HEADER = "X-Domaudit-Cache"
+
+# Finished project audit reports, shared by every user with access to the project.
+# Entries are weighed by job count, so a few huge reports cannot fill the worker's memory.
+# Each worker has its own cache, and a cached job's report columns take about 1 KB, so the
+# default budget holds about 20 MB per worker
+report_cache = cache.TTLCache("project_audit_reports",
+                              max_size=int(os.getenv("REPORT_CACHE_MAX_ENTRIES", 32)),
+                              ttl=float(os.getenv("REPORT_CACHE_TTL_SECONDS", 300)),
+                              max_weight=int(os.getenv("REPORT_CACHE_MAX_JOBS", 20000)))
+# Identical audits running at the same time share one computation
+report_flights = cache.SingleFlight()
+# Projects each caller has been allowed to read, keyed by a hash of their credentials and the project ID
+project_access_cache = cache.TTLCache("project_access",
+                                      max_size=int(os.getenv("AUTH_CACHE_MAX_SIZE", 1024)),
+                                      ttl=float(os.getenv("AUTH_CACHE_TTL_SECONDS", 60)))
+# Slow changing Domino metadata, shared by every caller. Each kind has its own TTL, and 0 disables it.
+# Access to a project is still checked per caller before anything cached about it is used
+METADATA_CACHE_MAX_SIZE = int(os.getenv("METADATA_CACHE_MAX_SIZE", 1024))
+install_config_cache = cache.TTLCache("install_config", max_size=1,
+                                      ttl=float(os.getenv("INSTALL_CONFIG_CACHE_TTL_SECONDS", 3600)))
+goals_cache = cache.TTLCache("project_goals", max_size=METADATA_CACHE_MAX_SIZE,
+                             ttl=float(os.getenv("GOALS_CACHE_TTL_SECONDS", 300)))
+# Projects by ID, and project IDs by owner and name
+project_cache = cache.TTLCache("projects", max_size=METADATA_CACHE_MAX_SIZE,
+                               ttl=float(os.getenv("PROJECT_CACHE_TTL_SECONDS", 600)))
+project_id_cache = cache.TTLCache("project_ids", max_size=METADATA_CACHE_MAX_SIZE,
+                                  ttl=float(os.getenv("PROJECT_CACHE_TTL_SECONDS", 600)))
+
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
 
 def api_fail(status_code, origin):
     """
-    Error message for if we don't get the expected htp code
+    Raise an UpstreamError if we don't get the expected http code. The app turns it into an error response.
     """
     logging.error(f"An API error has occured whilst running {origin}. Status code: {status_code}")
-    exit(1)
+    raise retry.UpstreamError(status_code, origin)
 
 def api_skip(status_code,error, origin):
     """
@@ -28,328 +67,1157 @@ def get_project_id(project_name, project_owner, auth_header):
     """
     Returns if of a project
     """
-    url = f"{api_host}/{constants.GATEWAY_ENDPOINT}/projects/findProjectByOwnerAndName"
-    params = {"ownerName": project_owner,
-              "projectName": project_name }
-    result = requests.get(url, params=params, headers=auth_header)
+    def find_project():
+        url = f"{api_host}/{constants.GATEWAY_ENDPOINT}/projects/findProjectByOwnerAndName"
+        params = {"ownerName": project_owner,
+                  "projectName": project_name }
+        result = http_client.get(url, params=params, headers=auth_header, endpoint="v4/gateway/projects/findProjectByOwnerAndName")
+        if result.status_code != 200:
+            api_fail(result.status_code, "get_project_id")
+        project_id = result.json().get("id", None)
+        # Raising rather than returning None keeps a project that was not found out of the cache
+        if project_id is None:
+            api_fail(404, "get_project_id")
+        return project_id
+    return project_id_cache.get_or_load((project_owner, project_name), find_project)
+
+
+def get_project(project_id, auth_header):
+    """
+    Returns the ID, name and owner username of a project
+    """
+    def load_project():
+        url = f"{api_host}/{constants.GET_PROJECTS_ENDPOINT}/{project_id}"
+        result = http_client.get(url, headers=auth_header, endpoint="v4/projects/{project_id}")
+        if result.status_code != 200:
+            api_fail(result.status_code, "get_project")
+        project = result.json()
+        return {"id": project_id, "name": project.get("name", None), "owner": project.get("ownerUsername", None)}
+    return project_cache.get_or_load(project_id, load_project)
+
+
+def check_project_access(project_id, auth_header):
+    """
+    Raise an UpstreamError unless the caller can read the project. Successful checks are cached briefly.
+    """
+    key = (cache.credential_key(auth_header), project_id)
+    if project_access_cache.get(key, False):
+        return
+    url = f"{api_host}/{constants.GET_PROJECTS_ENDPOINT}/{project_id}"
+    result = http_client.get(url, headers=auth_header, endpoint="v4/projects/{project_id}")
     if result.status_code != 200:
-        api_fail(result.status_code, "get_project_owner")
-    project_id = result.json().get("id", None)
-    return project_id    
+        api_fail(result.status_code, "check_project_access")
+    project_access_cache.set(key, True)
+    # The check reads the project anyway, so keep it for get_project
+    project = result.json()
+    project_cache.set(project_id, {"id": project_id, "name": project.get("name", None), "owner": project.get("ownerUsername", None)})
+
+
+def resolve_project(settings, auth_header):
+    """
+    Fill in whichever of project_id, or project_name and project_owner, the request left out,
+    and check the caller can read the project. Goals and cached reports are shared between
+    callers, so are only served to those who pass the check.
+    """
+    if not settings["project_id"]:
+        settings["project_id"] = get_project_id(settings["project_name"], settings["project_owner"], auth_header)
+    with timing.phase("access_check"):
+        check_project_access(settings["project_id"], auth_header)
+    if not settings["project_name"] or not settings["project_owner"]:
+        project = get_project(settings["project_id"], auth_header)
+        settings["project_name"] = settings["project_name"] or project["name"]
+        settings["project_owner"] = settings["project_owner"] or project["owner"]
 
 
 def get_project_owner(project_id, auth_header):
     """
     Returns username of the owner of a project
     """
-    url = f"{api_host}/{constants.GET_PROJECTS_ENDPOINT}/{project_id}"
-    result = requests.get(url, headers=auth_header)
-    if result.status_code != 200:
-        api_fail(result.status_code, "get_project_owner")
-    owner_username = result.json().get("ownerUsername", None)
-    return owner_username
+    return get_project(project_id, auth_header)["owner"]
+
 
+def invalidate_project_metadata(project_id):
+    """
+    Drop everything cached about a project, so it is read from Domino again
+    """
+    project = project_cache.get(project_id, None)
+    if project is not None:
+        project_id_cache.invalidate((project["owner"], project["name"]))
+    project_cache.invalidate(project_id)
+    goals_cache.invalidate(project_id)
 
-def get_jobs(project_id, auth_header, page_size, page_number):
+
+def get_jobs(project_id, auth_header, page_size, page_number, filters=None):
     """
     This will return a list of all job IDs from the selected project.
+    If filters are given, jobs the listing shows do not match them are left out.
     """
     url = f"{api_host}/{constants.JOBS_ENDPOINT}?projectId={project_id}&page_size={page_size}&page_no={page_number}&show_archived=true"
-    result = requests.get(url, headers=auth_header)
+    result = http_client.get(url, headers=auth_header, endpoint=constants.JOBS_ENDPOINT)
     if result.status_code != 200:
         api_fail(result.status_code, "get_jobs")
     jobs = result.json().get("jobs", None)
     job_ids = []
     for job in jobs:
-        job_ids.append(job.get("id", None))
+        if filters is None or job_matches(job, filters, listing=True):
+            job_ids.append(job.get("id", None))
     return job_ids
 
 
+async def get_job_listing_async(project_id, page_size, page_number, session):
+    """
+    Asynchronously return a page of the job listing from the selected project
+    """
+    url = f"{api_host}/{constants.JOBS_ENDPOINT}?projectId={project_id}&page_size={page_size}&page_no={page_number}&show_archived=true"
+    status, data = await http_client.get_json_async(session, url, endpoint=constants.JOBS_ENDPOINT)
+    if status != 200:
+        api_fail(status, "get_job_listing_async")
+    return data.get("jobs", None) or []
+
+
+def job_filters(args):
+    """
+    Returns the job filters given in request args, or None if there are none, and an error message if they are invalid.
+    status and user take comma separated values, from_date and to_date are YYYY-MM-DD days of submission, both included.
+    """
+    filters = {}
+    statuses = [status.strip().lower() for status in args.get('status', "").split(",") if status.strip()]
+    if statuses:
+        filters["statuses"] = frozenset(statuses)
+    users = [user.strip() for user in args.get('user', "").split(",") if user.strip()]
+    if users:
+        filters["users"] = frozenset(users)
+    try:
+        if args.get('from_date', None):
+            filters["from_ms"] = date_to_epoch_ms(args['from_date'])
+        if args.get('to_date', None):
+            filters["to_ms"] = date_to_epoch_ms(args['to_date']) + 86400 * 1000
+    except ValueError:
+        return None, "Invalid from_date or to_date. Expected YYYY-MM-DD"
+    return filters or None, None
+
+
+def positive_int_args(args, defaults):
+    """
+    Returns the named request args as positive integers, falling back to the given defaults,
+    and an error message if any of them is not one
+    """
+    values = {}
+    for name, default in defaults.items():
+        try:
+            values[name] = int(args.get(name, default))
+        except (TypeError, ValueError):
+            values[name] = 0
+        if values[name] < 1:
+            return None, f"Invalid {name}: {args.get(name, None)}. Expected a positive integer"
+    return values, None
+
+
+def job_matches(job, filters, listing=False):
+    """
+    Returns whether a job matches the filters. A job listing may leave fields out, so when
+    listing is set, a job is only excluded by the fields it has, and is checked again once enriched.
+    """
+    values = {
+        "statuses": ((job.get("statuses", None) or {}).get("executionStatus", None) or "").lower() or None,
+        "users": (job.get("startedBy", None) or {}).get("username", None),
+    }
+    for name in ("statuses", "users"):
+        if name in filters and (values[name] is not None or not listing) and values[name] not in filters[name]:
+            return False
+    submitted = (job.get("stageTime", None) or {}).get("submissionTime", None)
+    if submitted is None:
+        return listing or ("from_ms" not in filters and "to_ms" not in filters)
+    return filters.get("from_ms", submitted) <= submitted < filters.get("to_ms", submitted + 1)
+
+
+# Endpoints called for each job. The first holds the job itself, the rest add detail to it
+JOB_DATA_ENDPOINTS = [f"{constants.JOBS_ENDPOINT}/{{job_id}}",
+                      f"{constants.JOBS_ENDPOINT}/{{job_id}}/runtimeExecutionDetails",
+                      f"{constants.JOBS_ENDPOINT}/{{job_id}}/comments",
+                      f"{constants.JOBS_ENDPOINT}/job/{{job_id}}/artifactsInfo",
+                      f"{constants.JOBS_ENDPOINT}/project/{{project_id}}/codeInfo/{{job_id}}"]
+
+# Project audit report columns, in report order. Link columns are only included with links=true
+REPORT_COLUMNS = ["Comments", "Linked Repos", "Datasets", "External Volumes", "Goals", "Job Number", "Project Name",
+                  "Commit ID", "Results Commit URL", "Main Repo Commit URL", "Audit URL", "Command", "Hardware Tier",
+                  "Username", "Execution Status", "Submission Time", "Run Start Time", "Completed Time",
+                  "Environment Name", "Environment Version", "Execution Status Completed",
+                  "Execution Status Archived", "Execution Status Scheduled"]
+LINK_COLUMNS = ("Results Commit URL", "Main Repo Commit URL", "Audit URL")
+# Detail endpoints each column is read from. The rest only need the job itself, and no column needs artifactsInfo
+COLUMN_ENDPOINTS = {
+    "Comments": [JOB_DATA_ENDPOINTS[2]],
+    "Datasets": [JOB_DATA_ENDPOINTS[1]],
+    "External Volumes": [JOB_DATA_ENDPOINTS[1]],
+    "Linked Repos": [JOB_DATA_ENDPOINTS[4]],
+    "Main Repo Commit URL": [JOB_DATA_ENDPOINTS[4]],
+}
+
+
+def report_fields(value, create_links):
+    """
+    Returns the report columns named in a comma separated fields arg, in report order, and an error message
+    if any are unknown. Names are matched ignoring case, and underscores may stand for spaces.
+    """
+    by_name = {column.lower(): column for column in REPORT_COLUMNS}
+    fields = set()
+    for name in value.split(","):
+        name = name.strip().replace("_", " ").lower()
+        if not name or name == "job id":
+            continue
+        if name not in by_name:
+            return None, f"Unknown field: {name}. Valid values: Job ID, {', '.join(REPORT_COLUMNS)}"
+        if by_name[name] in LINK_COLUMNS and not create_links:
+            return None, f"Field {by_name[name]} needs links=true"
+        fields.add(by_name[name])
+    return [column for column in REPORT_COLUMNS if column in fields], None
+
+
+def job_data_endpoints(fields):
+    """
+    Returns the endpoints to call for each job to fill in the given report columns, or all of them if fields is None
+    """
+    if fields is None:
+        return JOB_DATA_ENDPOINTS
+    needed = {endpoint for field in fields for endpoint in COLUMN_ENDPOINTS.get(field, ())}
+    return [JOB_DATA_ENDPOINTS[0]] + [endpoint for endpoint in JOB_DATA_ENDPOINTS[1:] if endpoint in needed]
+
+
 def get_job_data(job_id, auth_header):
-    endpoints = [f"/{constants.JOBS_ENDPOINT}/{job_id}",
-                 f"/{constants.JOBS_ENDPOINT}/{job_id}/runtimeExecutionDetails",
-                 f"/{constants.JOBS_ENDPOINT}/{job_id}/comments",
-                 f"/{constants.JOBS_ENDPOINT}/job/{job_id}/artifactsInfo"]
     job_data = {}
-    for endpoint in endpoints:
-        url = f"{api_host}{endpoint}"
-        result = requests.get(url, headers=auth_header)
+    for template in JOB_DATA_ENDPOINTS[:4]:
+        url = f"{api_host}/{template.format(job_id=job_id)}"
+        result = http_client.get(url, headers=auth_header, endpoint=template)
         if result.status_code != 200:
             api_fail(result.status_code, "get_job_data")
         if result.json() is not None:
             job_data.update(result.json())
     return job_data
 
-async def get_async_api_data(endpoint, header, queue, session):
+async def get_async_api_data(template, job_id, project_id, session, required=False):
     """
-    Asynchronously retrieve data from an API endpoint and put it in a queue
+    Asynchronously retrieve data from an API endpoint.
+    Calls that still fail after retrying are skipped and return None, unless the data is required.
     """
-    url = f"{api_host}{endpoint}"
+    url = f"{api_host}/{template.format(job_id=job_id, project_id=project_id)}"
+    try:
+        status, data = await http_client.get_json_async(session, url, endpoint=template)
+    except retry.UpstreamError as e:
+        if required:
+            raise
+        api_skip(e.status_code, str(e), "get_async_api_data")
+        return None
+    if status != 200:
+        if required:
+            api_fail(status, f"get_async_api_data {template}")
+        api_skip(status, f"{url}", "get_async_api_data")
+        return None
+    return data or {}
 
-    async with session.get(url) as response:
-        if response.status != 200:
-            api_skip(response.status, f"{url}", "get_async_api_data")
-            await queue.put({})
-        else:                
-            data = await response.json()
-            await queue.put(data)
-
-async def get_job_data_async(job_id, project_id, auth_header, session):
-    endpoints = [f"/{constants.JOBS_ENDPOINT}/{job_id}",
-                 f"/{constants.JOBS_ENDPOINT}/{job_id}/runtimeExecutionDetails",
-                 f"/{constants.JOBS_ENDPOINT}/{job_id}/comments",
-                 f"/{constants.JOBS_ENDPOINT}/job/{job_id}/artifactsInfo",
-                 f"/{constants.JOBS_ENDPOINT}/project/{project_id}/codeInfo/{job_id}"]
+async def get_job_data_async(job_id, project_id, auth_header, session, endpoints=JOB_DATA_ENDPOINTS):
+    """
+    Returns a job merged with the detail from each of its endpoints, or from the given subset of them.
+    If a detail endpoint could not be read or was left out, the job is marked partial, so it is never kept in the job store.
+    """
+    results = await asyncio.gather(*[get_async_api_data(template, job_id, project_id, session, required=template == JOB_DATA_ENDPOINTS[0])
+                                     for template in endpoints])
     job_data = {}
-
-    queue = asyncio.Queue()
-    # Create tasks for each endpoint to be processed asynchronously
-    tasks = [get_async_api_data(endpoint, auth_header, queue, session) for endpoint in endpoints]
-    await asyncio.gather(*tasks)  # Await all tasks
-
-    while not queue.empty():
-        job = await queue.get()
-        if job:
-            job_data.update(job)
-
-    
+    for data in results:
+        if data:
+            job_data.update(data)
+    if None in results or len(endpoints) < len(JOB_DATA_ENDPOINTS):
+        job_data[job_store.PARTIAL_KEY] = True
     return job_data
 
 
 def get_goals(project_id, auth_header):
-    url = f"{api_host}/{constants.PROJECTMANAGEMENT_ENDPOINT}/{project_id}/goals"
-    result = requests.get(url, headers=auth_header)
-    if result.status_code != 200:
-        api_fail(result.status_code, "get_goals")
+    """
+    Returns a project's goal titles keyed by goal ID. Callers must have checked the caller can read the project.
+    """
+    def load_goals():
+        url = f"{api_host}/{constants.PROJECTMANAGEMENT_ENDPOINT}/{project_id}/goals"
+        result = http_client.get(url, headers=auth_header, endpoint="v4/projectManagement/{project_id}/goals")
+        if result.status_code != 200:
+            api_fail(result.status_code, "get_goals")
+        return goal_titles(result.json())
+    return goals_cache.get_or_load(project_id, load_goals)
+
+
+def goal_titles(goals_json):
+    """
+    Returns a project's goal titles keyed by goal ID
+    """
     goals = {}
-    for goal in result.json():
+    for goal in goals_json:
         goals[goal.get("id", None)] = goal.get("title", None)
     return goals
 
 
-async def aggregate_job_data(job_ids, project_id, auth_header, threads):
+async def single_page(job_ids):
+    """
+    Wrap a list of job IDs so it can be fed to enrich_jobs like a paged listing
+    """
+    yield job_ids
+
+
+async def project_pages(project_id, job_pages):
+    """
+    Pair each job ID in a project's pages with the project ID, as enrich_jobs expects
+    """
+    async for job_ids in job_pages:
+        yield [(project_id, job_id) for job_id in job_ids]
+
+
+async def enrich_jobs(job_pages, auth_header, session, workers, limiter=None, endpoints=JOB_DATA_ENDPOINTS, filters=None):
     """
-    Aggregate job data for multiple job IDs asynchronously
+    Yield job data from a bounded producer/consumer pipeline.
+    A producer feeds (project ID, job ID) pairs from job_pages into a bounded work queue, a fixed pool
+    of workers enriches them, and finished jobs are yielded as they complete.
+    At most a few jobs per worker are held in memory at any time.
+    If an adaptive limiter is given, it decides how many of the workers may call Nucleus at once.
+    Only the given endpoints are called for each job, and jobs that do not match filters once enriched are dropped.
+    """
+    limiter = limiter or concurrency.AdaptiveLimiter(workers, adaptive=False)
+    work_queue = asyncio.Queue(maxsize=workers * 2)
+    done_queue = asyncio.Queue(maxsize=workers * 2)
+    finished = object()
+
+    async def producer():
+        async for jobs in job_pages:
+            for job in jobs:
+                await work_queue.put(job)
+        for _ in range(workers):
+            await work_queue.put(finished)
+
+    async def worker():
+        try:
+            while True:
+                item = await work_queue.get()
+                if item is finished:
+                    break
+                project_id, job_id = item
+                async with limiter:
+                    with metrics.ENRICHMENT_IN_FLIGHT.track_inprogress():
+                        t = time.monotonic()
+                        job = await get_job_data_async(job_id, project_id, auth_header, session, endpoints)
+                        timing.record_job(job_id, time.monotonic() - t)
+                if filters is None or job_matches(job, filters):
+                    await done_queue.put(job)
+        except Exception as e:
+            await done_queue.put(e)
+        finally:
+            await done_queue.put(finished)
+
+    async def watch_producer(task):
+        # Surface listing errors to the consumer instead of losing them in the task
+        try:
+            await task
+        except Exception as e:
+            await done_queue.put(e)
+
+    producer_task = asyncio.create_task(producer())
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    tasks.append(asyncio.create_task(watch_producer(producer_task)))
+    try:
+        running = workers
+        while running:
+            job = await done_queue.get()
+            if job is finished:
+                running -= 1
+            elif isinstance(job, Exception):
+                raise job
+            else:
+                yield job
+        logging.info(f"Job enrichment finished: {limiter.summary()}")
+    finally:
+        producer_task.cancel()
+        for task in tasks:
+            task.cancel()
+
+
+async def aggregate_job_data(job_ids, project_id, auth_header, threads, limiter=None, endpoints=JOB_DATA_ENDPOINTS, filters=None):
+    """
+    Aggregate job data for multiple job IDs asynchronously.
+    threads is the most calls made at once, and an adaptive limiter may choose fewer.
     """
     jobs = {}
-    connector = TCPConnector(limit=threads)
-    async with ClientSession(connector=connector,headers=auth_header) as session:  # Use a single session for all requests
-        # Create tasks for each job ID
-        tasks = [get_job_data_async(job_id, project_id, auth_header, session) for job_id in job_ids]
-        results = await asyncio.gather(*tasks)  # Await all tasks
-
-    # Update the jobs dictionary with the results
-    for job in results:
+    async for job in enrich_job_ids(project_id, job_ids, auth_header, threads, limiter, endpoints, filters):
         jobs[job.get("id", None)] = job
     return jobs
 
 
+async def iter_job_pages(project_id, page_size, page_number, session, all_pages=True, filters=None):
+    """
+    Yield pages of job IDs from a project, starting at page_number.
+    The next page is requested while the caller processes the current one.
+    If filters are given, jobs the listing shows do not match them are left out, and pages left empty are skipped.
+    """
+    next_page = asyncio.create_task(get_job_listing_async(project_id, page_size, page_number, session))
+    try:
+        while True:
+            jobs = await next_page
+            if not jobs:
+                break
+            # A short page means there is nothing left to prefetch
+            last_page = not all_pages or len(jobs) < page_size
+            if not last_page:
+                next_page = asyncio.create_task(get_job_listing_async(project_id, page_size, page_number + 1, session))
+
+            job_ids = [job.get("id", None) for job in jobs if filters is None or job_matches(job, filters, listing=True)]
+            logging.info(f"Aggregating {len(job_ids)} of {len(jobs)} jobs from page {page_number}...")
+            if job_ids:
+                yield job_ids
+
+            if last_page:
+                break
+            page_number += 1
+    finally:
+        next_page.cancel()
+
+
+async def stream_job_data(project_id, auth_header, threads, page_size, page_number=1, all_pages=False, incremental=False, limiter=None, progress=None,
+                          endpoints=JOB_DATA_ENDPOINTS, filters=None):
+    """
+    Yield each job's data as soon as all of its endpoint calls have completed.
+    In incremental mode, completed jobs already in the job store are yielded from the store
+    instead of being fetched again, and newly completed jobs are added to it.
+    progress, if given, is called with jobs_listed as each page of job IDs is read.
+    endpoints and filters are passed to enrich_jobs, and filters are also applied to the job listing.
+    The job store is sqlite, so it is read and written in the loop's executor rather than blocking the event loop.
+    """
+    cached_jobs = []
+    fresh_jobs = []
+    loop = asyncio.get_running_loop()
+    if incremental:
+        logging.info(f"Incremental audit of {project_id}")
+
+    async def counted_pages(job_pages):
+        listed = 0
+        async for job_ids in job_pages:
+            listed += len(job_ids)
+            progress(jobs_listed=listed)
+            yield job_ids
+
+    async def uncached_pages(job_pages):
+        async for job_ids in job_pages:
+            cached = await loop.run_in_executor(None, job_store.get_completed_jobs, project_id, job_ids)
+            logging.info(f"{len(cached)} of {len(job_ids)} jobs found in the job store")
+            cached_jobs.extend(cached.values())
+            yield [job_id for job_id in job_ids if job_id not in cached]
+
+    observers = [limiter.observe] if limiter else ()
+    async with http_client.async_session(auth_header, threads, observers) as session:
+        job_pages = iter_job_pages(project_id, page_size, page_number, session, all_pages=all_pages, filters=filters)
+        if progress:
+            job_pages = counted_pages(job_pages)
+        if incremental:
+            job_pages = uncached_pages(job_pages)
+        async for job in enrich_jobs(project_pages(project_id, job_pages), auth_header, session, threads, limiter, endpoints, filters):
+            while cached_jobs:
+                yield cached_jobs.pop()
+            if incremental:
+                fresh_jobs.append(job)
+                if len(fresh_jobs) >= JOB_STORE_BATCH_SIZE:
+                    await loop.run_in_executor(None, job_store.save_jobs, project_id, list(fresh_jobs))
+                    fresh_jobs.clear()
+            yield job
+        while cached_jobs:
+            yield cached_jobs.pop()
+
+    if incremental:
+        await loop.run_in_executor(None, job_store.save_jobs, project_id, fresh_jobs)
+
+
+async def enrich_job_ids(project_id, job_ids, auth_header, threads, limiter=None, endpoints=JOB_DATA_ENDPOINTS, filters=None):
+    """
+    Yield the data of the given jobs as each is enriched, in a session of its own
+    """
+    observers = [limiter.observe] if limiter else ()
+    async with http_client.async_session(auth_header, threads, observers) as session:  # Use a single session for all requests
+        async for job in enrich_jobs(project_pages(project_id, single_page(job_ids)), auth_header, session, threads, limiter,
+                                     endpoints, filters):
+            yield job
+
+
+async def stream_sharded_job_data(project_id, auth_header, threads, page_size, page_number=1, limiter=None, progress=None,
+                                  fields=None, endpoints=JOB_DATA_ENDPOINTS, filters=None):
+    """
+    Yield each job's data, with the jobs of large audits enriched in shards by the other replicas.
+    Every job ID is listed first. Audits of fewer than SHARD_MIN_JOBS jobs, or with no other replica
+    to help, are enriched here as stream_job_data would.
+    """
+    observers = [limiter.observe] if limiter else ()
+    job_ids = []
+    async with http_client.async_session(auth_header, threads, observers) as session:
+        async for page in iter_job_pages(project_id, page_size, page_number, session, all_pages=True, filters=filters):
+            job_ids.extend(page)
+            if progress:
+                progress(jobs_listed=len(job_ids))
+
+    peers = await sharding.discover_peers() if len(job_ids) >= sharding.SHARD_MIN_JOBS else []
+    if len(peers) < 2:
+        async for job in enrich_job_ids(project_id, job_ids, auth_header, threads, limiter, endpoints, filters):
+            yield job
+        return
+
+    # Every shard in flight gets an equal part of the audit's threads, so the replicas together make
+    # no more concurrent calls to Domino than the audit would on its own
+    shard_threads = sharding.shard_threads(threads, peers)
+
+    def enrich_locally(shard):
+        return enrich_job_ids(project_id, shard, auth_header, shard_threads, limiter, endpoints, filters)
+
+    payload = {"project_id": project_id, "fields": fields, "thread_count": shard_threads}
+    async for job in sharding.stream_shards(job_ids, peers, payload, auth_header, enrich_locally):
+        # Replicas check the listing filters again once jobs are enriched
+        if filters is None or job_matches(job, filters):
+            yield job
+
+
+def audit_job_stream(settings, auth_header, limiter, progress=None):
+    """
+    Returns the async stream of job data for a project audit, sharded across replicas when
+    sharding is enabled and the audit reads every page. Incremental audits are never sharded.
+    """
+    if sharding.enabled() and settings["all_pages"] and not settings["incremental"]:
+        return stream_sharded_job_data(settings["project_id"], auth_header, settings["threads"], settings["page_size"],
+                                       settings["page_number"], limiter, progress, fields=settings["fields"],
+                                       endpoints=settings["endpoints"], filters=settings["filters"])
+    return stream_job_data(settings["project_id"], auth_header, settings["threads"], settings["page_size"], settings["page_number"],
+                           settings["all_pages"], settings["incremental"], limiter, progress=progress,
+                           endpoints=settings["endpoints"], filters=settings["filters"])
+
+
+async def collect_job_data(job_stream):
+    """
+    Gather a stream of job data into a dictionary keyed by job ID
+    """
+    jobs = {}
+    async for job in job_stream:
+        jobs[job.get("id", None)] = job
+    return jobs
+
+
+def iterate_async(async_generator):
+    """
+    Drive an async generator from synchronous code, such as a streamed Flask response, on the worker's event loop
+    """
+    return event_loop.iterate(async_generator)
+
+
 def convert_datetime(time_str):
     return datetime.datetime.fromtimestamp(time_str / 1e3, tz=datetime.timezone.utc).strftime('%F %X:%f %Z')
 
 
+def get_domino_host(auth_header):
+    """
+    Returns the public hostname of the Domino install, used when building links.
+    It is the same for every caller, so it is cached for INSTALL_CONFIG_CACHE_TTL_SECONDS.
+    """
+    def load_install_config():
+        domino_host = api_host
+        url = f"{api_host}/currentInstallConfig"
+        result = http_client.get(url, headers=auth_header, endpoint="currentInstallConfig")
+        if result.status_code != 200:
+            api_fail(result.status_code, "current_install_config")
+        else:
+            domino_host = result.json()['host']
+        return domino_host
+    return install_config_cache.get_or_load(api_host, load_install_config)
+
+
+def generate_job_report(job_data, goals, project_name, project_owner, project_id, create_links, domino_host):
+    """
+    Returns the tidied report row for a single job
+    """
+    tidy_job = {}
+    comments = []
+    if job_data.get("comments", None):
+        for comment_details in job_data.get("comments", '[]'):
+            comment = {
+                'comment-username': comment_details.get("commenter", None).get("username", None),
+                'comment-timestamp': convert_datetime(comment_details.get("created", 0)),
+                'comment-value': comment_details.get("commentBody", None).get("value", None)
+            }
+            comments.append(comment)
+    tidy_job['Comments'] = comments
+    git_repos = []
+    if job_data.get("dependentRepositories", None):
+        for repo in job_data.get("dependentRepositories", '[]'):
+            repo_details = {
+                "Repo URI": repo.get("uri", None),
+                "Starting Branch": repo.get("startingBranch", None),
+                "Starting Commit ID ": repo.get("startingCommitId", None) ,
+                "Starting Commit URI ": repo.get("startingCommitUri", None)
+            }
+            # repo_uri = repo.get("uri", None)
+            git_repos.append(repo_details)
+    tidy_job['Linked Repos'] = git_repos
+    dataset_names = []
+    if job_data.get("dependentDatasetMounts", None):
+        for dataset in job_data.get("dependentDatasetMounts", '[]'):
+            datasets = {
+                "Dataset Name": dataset.get("datasetName", None),
+                "Dataset Snapshot version": dataset.get("snapshotVersion", None)
+            }
+            # dataset_name = dataset.get("datasetName", None)
+            dataset_names.append(datasets)
+    tidy_job['Datasets'] = dataset_names
+
+    datavolume_names = []
+    if job_data.get("dependentExternalVolumeMounts", None):
+        for volume in job_data.get("dependentExternalVolumeMounts", '[]'):
+            volume_info = {
+                "Volume Name": volume.get("name", None)
+            }
+            if volume.get("mount",None):
+                volume_info["Volume Mount Point"] = volume.get("mount").get("mountPath",None)
+                volume_info["Volume Read Only"] = volume.get("mount").get("readOnly",None)
+            
+            datavolume_names.append(volume_info)
+    tidy_job['External Volumes'] = datavolume_names
+    
+    goal_names = []
+    if job_data.get("goalIds", None):
+        for goal_id in job_data.get("goalIds", '[]'):
+            goal_names.append(goals[goal_id])
+    tidy_job['Goals'] = goal_names
+    tidy_job['Job Number'] = job_data.get("number", None)  
+    tidy_job['Project Name'] = project_name
+    endStateCommit = None
+    if job_data:
+        if job_data.get("endState"):
+          endStateCommit = job_data.get("endState").get("commitId", None)
+    tidy_job["Commit ID"] = endStateCommit
+    if job_data.get("mainRepo", None):
+        main_repo_commit_url = job_data.get("mainRepo").get("commitResourceLink", None)
+    else:
+        commit_detail = job_data.get("commitDetails", {})
+        main_repo_commit = commit_detail.get("inputCommitId", None)
+        if main_repo_commit:
+            main_repo_commit_url = f"{domino_host}/u/{project_owner}/{project_name}/browse?commitId={main_repo_commit}"
+        else:
+            main_repo_commit_url = None
+    if create_links:
+        commit_url = f"{domino_host}/u/{project_owner}/{project_name}/browse?commitId={endStateCommit}"
+        tidy_job["Results Commit URL"] = commit_url
+        tidy_job["Main Repo Commit URL"] = main_repo_commit_url
+        audit_url = f"{domino_host}/projects/{project_id}/auditLog"
+        tidy_job["Audit URL"] = audit_url
+    tidy_job["Command"] = job_data.get("jobRunCommand", None)
+    tidy_job["Hardware Tier"] = job_data.get("hardwareTier", None)
+    tidy_job["Username"] = job_data.get("startedBy", None).get("username", None)
+    tidy_job["Execution Status"] = job_data.get("statuses", None).get("executionStatus", None)
+    tidy_job["Submission Time"] = convert_datetime(job_data.get("stageTime", 0).get("submissionTime", 0))
+    if job_data.get("stageTime", None).get("runStartTime", None):
+        tidy_job["Run Start Time"] = convert_datetime(job_data.get("stageTime", 0).get("runStartTime", 0))
+    else:
+        tidy_job["Run Start Time"] = None
+    tidy_job["Completed Time"] = convert_datetime(job_data.get("stageTime", 0).get("completedTime", 0))
+    tidy_job["Environment Name"] = job_data.get("environment", None).get("environmentName", None)
+    tidy_job["Environment Version"] = job_data.get("environment", None).get("revisionNumber", None)
+    tidy_job["Execution Status Completed"] = job_data.get("statuses", None).get("isCompleted", None)
+    tidy_job["Execution Status Archived"] = job_data.get("statuses", None).get("isArchived", None)
+    tidy_job["Execution Status Scheduled"] = job_data.get("statuses", None).get("isScheduled", None)
+    return tidy_job
+
+
 def generate_report(jobs, goals, project_name, project_owner, project_id, create_links, auth_header):
     tidy_jobs = {}
     # Pull domino hostname
-    domino_host = api_host
-    url = f"{api_host}/currentInstallConfig"
-    result = requests.get(url, headers=auth_header)
-    if result.status_code != 200:
-        api_fail(result.status_code, "current_install_config")
-    else:
-        domino_host = result.json()['host']
+    domino_host = get_domino_host(auth_header)
 
     for job in jobs:
-        tidy_jobs[job] = {}
-        comments = []
-        if jobs.get(job, None).get("comments", None):
-            for comment_details in jobs.get(job, None).get("comments", '[]'):
-                comment = {
-                    'comment-username': comment_details.get("commenter", None).get("username", None),
-                    'comment-timestamp': convert_datetime(comment_details.get("created", 0)),
-                    'comment-value': comment_details.get("commentBody", None).get("value", None)
-                }
-                comments.append(comment)
-        tidy_jobs[job]['Comments'] = comments
-        git_repos = []
-        if jobs.get(job, None).get("dependentRepositories", None):
-            for repo in jobs.get(job, None).get("dependentRepositories", '[]'):
-                repo_details = {
-                    "Repo URI": repo.get("uri", None),
-                    "Starting Branch": repo.get("startingBranch", None),
-                    "Starting Commit ID ": repo.get("startingCommitId", None) ,
-                    "Starting Commit URI ": repo.get("startingCommitUri", None)
-                }
-                # repo_uri = repo.get("uri", None)
-                git_repos.append(repo_details)
-        tidy_jobs[job]['Linked Repos'] = git_repos
-        dataset_names = []
-        if jobs.get(job, None).get("dependentDatasetMounts", None):
-            for dataset in jobs.get(job, None).get("dependentDatasetMounts", '[]'):
-                datasets = {
-                    "Dataset Name": dataset.get("datasetName", None),
-                    "Dataset Snapshot version": dataset.get("snapshotVersion", None)
-                }
-                # dataset_name = dataset.get("datasetName", None)
-                dataset_names.append(datasets)
-        tidy_jobs[job]['Datasets'] = dataset_names
-
-        datavolume_names = []
-        if jobs.get(job, None).get("dependentExternalVolumeMounts", None):
-            for volume in jobs.get(job, None).get("dependentExternalVolumeMounts", '[]'):
-                volume_info = {
-                    "Volume Name": volume.get("name", None)
-                }
-                if volume.get("mount",None):
-                    volume_info["Volume Mount Point"] = volume.get("mount").get("mountPath",None)
-                    volume_info["Volume Read Only"] = volume.get("mount").get("readOnly",None)
-                
-                datavolume_names.append(volume_info)
-        tidy_jobs[job]['External Volumes'] = datavolume_names
-        
-        goal_names = []
-        if jobs.get(job, None).get("goalIds", None):
-            for goal_id in jobs.get(job, None).get("goalIds", '[]'):
-                goal_names.append(goals[goal_id])
-        tidy_jobs[job]['Goals'] = goal_names
-        tidy_jobs[job]['Job Number'] = jobs.get(job, None).get("number", None)  
-        tidy_jobs[job]['Project Name'] = project_name
-        endStateCommit = None
-        if jobs.get(job):
-            if jobs.get(job).get("endState"):
-              endStateCommit = jobs.get(job).get("endState").get("commitId", None)
-        tidy_jobs[job]["Commit ID"] = endStateCommit
-        if jobs.get(job, None).get("mainRepo", None):
-            main_repo_commit_url = jobs.get(job).get("mainRepo").get("commitResourceLink", None)
-        else:
-            commit_detail = jobs.get(job, {}).get("commitDetails", {})
-            main_repo_commit = commit_detail.get("inputCommitId", None)
-            if main_repo_commit:
-                main_repo_commit_url = f"{domino_host}/u/{project_owner}/{project_name}/browse?commitId={main_repo_commit}"
-            else:
-                main_repo_commit_url = None
-        if create_links:
-            commit_url = f"{domino_host}/u/{project_owner}/{project_name}/browse?commitId={endStateCommit}"
-            tidy_jobs[job]["Results Commit URL"] = commit_url
-            tidy_jobs[job]["Main Repo Commit URL"] = main_repo_commit_url
-            audit_url = f"{domino_host}/projects/{project_id}/auditLog"
-            tidy_jobs[job]["Audit URL"] = audit_url
-        tidy_jobs[job]["Command"] = jobs.get(job, None).get("jobRunCommand", None)
-        tidy_jobs[job]["Hardware Tier"] = jobs.get(job, None).get("hardwareTier", None)
-        tidy_jobs[job]["Username"] = jobs.get(job, None).get("startedBy", None).get("username", None)
-        tidy_jobs[job]["Execution Status"] = jobs.get(job, None).get("statuses", None).get("executionStatus", None)
-        tidy_jobs[job]["Submission Time"] = convert_datetime(jobs.get(job, 0).get("stageTime", 0).get("submissionTime", 0))
-        if jobs.get(job, None).get("stageTime", None).get("runStartTime", None):
-            tidy_jobs[job]["Run Start Time"] = convert_datetime(jobs.get(job, 0).get("stageTime", 0).get("runStartTime", 0))
-        else:
-            tidy_jobs[job]["Run Start Time"] = None
-        tidy_jobs[job]["Completed Time"] = convert_datetime(jobs.get(job, 0).get("stageTime", 0).get("completedTime", 0))
-        tidy_jobs[job]["Environment Name"] = jobs.get(job, None).get("environment", None).get("environmentName", None)
-        tidy_jobs[job]["Environment Version"] = jobs.get(job, None).get("environment", None).get("revisionNumber", None)
-        tidy_jobs[job]["Execution Status Completed"] = jobs.get(job, None).get("statuses", None).get("isCompleted", None)
-        tidy_jobs[job]["Execution Status Archived"] = jobs.get(job, None).get("statuses", None).get("isArchived", None)
-        tidy_jobs[job]["Execution Status Scheduled"] = jobs.get(job, None).get("statuses", None).get("isScheduled", None)
+        tidy_jobs[job] = generate_job_report(jobs[job], goals, project_name, project_owner, project_id, create_links, domino_host)
     return tidy_jobs
 
+def stream_report(job_stream, goals, project_name, project_owner, project_id, create_links, domino_host, fields=None):
+    """
+    Yield the report as newline delimited JSON, one job per line, with only the given fields if there are any
+    """
+    rows = 0
+    t = datetime.datetime.now()
+    for job_data in job_stream:
+        row = {"Job ID": job_data.get("id", None)}
+        report = generate_job_report(job_data, goals, project_name, project_owner, project_id, create_links, domino_host)
+        row.update(report if fields is None else {field: report[field] for field in fields})
+        rows += 1
+        yield json.dumps(row) + "\n"
+    t = datetime.datetime.now() - t
+    logging.info(f"Streamed {rows} jobs in {str(round(t.total_seconds(),1))} seconds.")
+
+
+def date_to_epoch_ms(date_str):
+    """
+    Convert a YYYY-MM-DD date to epoch milliseconds at midnight UTC
+    """
+    utc_time = datetime.datetime.strptime(date_str, "%Y-%m-%d")
+    return round((utc_time - datetime.datetime(1970, 1, 1)).total_seconds()) * 1000
+
+
+def encode_cursor(latest_timestamp, seen_ids):
+    """
+    Returns an opaque cursor that resumes an activity report from latest_timestamp
+    """
+    cursor = json.dumps({"latest": latest_timestamp, "seen": sorted(seen_ids)})
+    return base64.urlsafe_b64encode(cursor.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Returns the latest timestamp and already returned activity IDs from a cursor
+    """
+    state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    return int(state["latest"]), set(state.get("seen", []))
+
+
+def activity_id(activity):
+    # Not every activity type has an id, so fall back to the fields that identify an event
+    return activity.get("id", None) or f'{activity["timestamp"]}:{activity["activitySource"]}:{activity["activity"]}'
+
+
+def get_activity_page(project_id, page_size, latest_timestamp, source, auth_header):
+    """
+    Returns one page of project activity, newest first, at or before latest_timestamp
+    """
+    url = f"{api_host}/{constants.ACTIVITY_ENDPOINT}?projectId={project_id}&pageSize={page_size}"
+    if latest_timestamp is not None:
+        url = f"{url}&latestTimeStamp={latest_timestamp}"
+    if source:
+        url = f"{url}&filterBy={source}"
+
+    result = http_client.get(url, headers=auth_header, endpoint=constants.ACTIVITY_ENDPOINT)
+    if result.status_code != 200:
+        api_fail(result.status_code, "get_project_activity")
+    return result.json()["activity"]
+
+
+def iter_project_activity(project_id, page_size, latest_timestamp, source, from_timestamp, max_pages, auth_header, seen_ids=None, state=None):
+    """
+    Yield project activity newest first, paging backwards through latestTimeStamp.
+    Without from_timestamp only one page is returned. Otherwise pages are fetched until
+    activity older than from_timestamp is reached, or max_pages pages have been read.
+    If activity may remain, state["cursor"] is set to a cursor that resumes from there.
+    """
+    seen_ids = seen_ids or set()
+    state = state if state is not None else {}
+    pages = 0
+    while True:
+        with timing.phase("activity_listing"):
+            activities = get_activity_page(project_id, page_size, latest_timestamp, source, auth_header)
+        pages += 1
+        new_rows = 0
+        for activity in activities:
+            if from_timestamp is not None and activity["timestamp"] < from_timestamp:
+                return
+            key = activity_id(activity)
+            if key in seen_ids:
+                continue
+            # Only activity sharing the oldest timestamp can come back on the next page
+            if activity["timestamp"] != latest_timestamp:
+                latest_timestamp = activity["timestamp"]
+                seen_ids = set()
+            seen_ids.add(key)
+            new_rows += 1
+            yield activity
+
+        if len(activities) < page_size:
+            return
+        if new_rows == 0:
+            # A whole page shared one timestamp, step past it rather than asking for it again
+            latest_timestamp -= 1
+            seen_ids = set()
+        if from_timestamp is None or pages >= max_pages:
+            state["cursor"] = encode_cursor(latest_timestamp, seen_ids)
+            return
+
+
+def format_activity_times(epoch_ms):
+    return report_builder.format_timestamps(report_builder.to_datetimes(epoch_ms))
+
+
+# Activity timestamps stay as epoch milliseconds in the row buffer, and are formatted when it is written out
+ACTIVITY_TIMESTAMP_COLUMNS = {"Timestamp": format_activity_times}
+
+
+def transform_activity(activity):
+    """
+    Returns the report row for a single activity. The timestamp is left in epoch milliseconds.
+    """
+    activityBy = activity.get("activityBy",None)
+    commit_message = ""
+    files_changed = ""
+    run_id = ""
+    file_action = ""
+    status = ""
+    if "metadata" in activity:
+        data = activity["metadata"].get("data",{})
+
+        commit_message = data.get("commitMessage","")
+        files_changed = ",".join(data.get("filesChanged",[]))
+        file_action = data.get("action","")
+        status = data.get("currentStatus","")
+
+    # TODO: what??
+    # if activity["activitySource"] in ["job","workspace"]:
+    #     run_id = activity["sourceId"]
+    # elif "metadata" in activity:
+    #     if activity["metadata"]["data"].get("fileChangedDueTo","") == "workspace"
+
+    return {
+        "Activity": activity["activity"],
+        "Timestamp": activity["timestamp"],
+        "User": activityBy['username'] if activityBy else "",
+        "Source": activity["activitySource"],
+        "Status": status,
+        "CommitMessage": commit_message,
+        "Action": file_action,
+        "Files Changed": files_changed
+    }
+
+
+def stream_activity(activities, state):
+    """
+    Yield activity rows as newline delimited JSON. If activity remains, the last line holds the resume cursor.
+    """
+    rows = metrics.count_rows("/project_activity", (transform_activity(activity) for activity in activities))
+    yield from row_buffer.stream_ndjson(rows, ACTIVITY_COLUMNS, ACTIVITY_TIMESTAMP_COLUMNS)
+    if state.get("cursor", None):
+        yield json.dumps({"cursor": state["cursor"]}) + "\n"
+
+
 def get_project_activity(auth_header, requesting_user, args=None):
     
-    if not "project_id" in args:
+    if not "project_id" in args and not all(key in args for key in ("project_name","project_owner")):
         logging.error(f"No project details have been supplied. Args sent: {args}")
         error = {
-            "message": "Usage: /project_activity?project_id=<project_id>"
+            "message": "Usage: /project_activity?project_id=<project_id> or ?project_name=<project_name>&project_owner=<project_owner>"
         }
         return make_response(error,400)
     
     logging.info(f"Args sent: {args}")
 
     project_id = args.get('project_id', None)
-    page_size = args.get('page_size', 500)
+    if not project_id:
+        project_id = get_project_id(args['project_name'], args['project_owner'], auth_header)
+    numbers, error = positive_int_args(args, {"page_size": 500, "max_pages": ACTIVITY_MAX_PAGES})
+    if error:
+        return make_response({"message": error}, 400)
+    page_size = numbers["page_size"]
     latest_event_time = args.get('latest_event_time',None)
+    from_date = args.get('from_date', None)
+    max_pages = numbers["max_pages"]
+    cursor = args.get('cursor', None)
     source = args.get('activity_source',None)
+    output_format = args.get('format', "json").lower()
+    if output_format not in ACTIVITY_FORMATS:
+        error = {
+            "message": f"Unsupported format: {output_format}. Valid values: {', '.join(ACTIVITY_FORMATS)}"
+        }
+        return make_response(error,400)
 
     logging.info(f"{requesting_user} requested activity report for {project_id}...")
 
-    url = f"{api_host}/{constants.ACTIVITY_ENDPOINT}?projectId={project_id}&pageSize={page_size}"
-    if latest_event_time:
-        utc_time = datetime.datetime.strptime(latest_event_time, "%Y-%m-%d")
-        epoch_time_ms = round((utc_time - datetime.datetime(1970, 1, 1)).total_seconds()) * 1000
-        url = f"{url}&latestTimeStamp={epoch_time_ms}"
-    
-    if source:
-        url = f"{url}&filterBy={source}"
+    try:
+        latest_timestamp = date_to_epoch_ms(latest_event_time) if latest_event_time else None
+        from_timestamp = date_to_epoch_ms(from_date) if from_date else None
+    except ValueError:
+        return make_response({"message": "Invalid latest_event_time or from_date. Expected YYYY-MM-DD"}, 400)
+    seen_ids = set()
+    if cursor:
+        try:
+            latest_timestamp, seen_ids = decode_cursor(cursor)
+        except (ValueError, KeyError, TypeError):
+            return make_response({"message": "Invalid cursor"}, 400)
 
-    result = requests.get(url, headers=auth_header)
-    if result.status_code != 200:
-        api_fail(result.status_code, "get_project_activity")
-    
-    output = {}
-    for activity in result.json()["activity"]:
-        activityBy = activity.get("activityBy",None)
-        commit_message = ""
-        files_changed = ""
-        run_id = ""
-        file_action = ""
-        status = ""
-        if "metadata" in activity:
-            data = activity["metadata"].get("data",{})
-
-            commit_message = data.get("commitMessage","")
-            files_changed = ",".join(data.get("filesChanged",[]))
-            file_action = data.get("action","")
-            status = data.get("currentStatus","")
-
-        # TODO: what??
-        # if activity["activitySource"] in ["job","workspace"]:
-        #     run_id = activity["sourceId"]
-        # elif "metadata" in activity:
-        #     if activity["metadata"]["data"].get("fileChangedDueTo","") == "workspace"
-         
-        output[activity["timestamp"]] = {
-            "Activity": activity["activity"],
-            "Timestamp": convert_datetime(activity["timestamp"]),
-            "User": activityBy['username'] if activityBy else "",
-            "Source": activity["activitySource"],
-            "Status": status,
-            "CommitMessage": commit_message,
-            "Action": file_action,
-            "Files Changed": files_changed
-        }
-    return output
+    state = {}
+    activities = iter_project_activity(project_id, page_size, latest_timestamp, source, from_timestamp, max_pages,
+                                       auth_header, seen_ids, state)
 
+    if output_format == "ndjson":
+        return Response(timing.with_trailer(stream_activity(activities, state), "/project_activity"),
+                        mimetype="application/x-ndjson")
 
-def main(auth_header, requesting_user, args=None):
-    t0 = datetime.datetime.now()
-    if not all(key in args for key in ("project_name","project_owner","project_id")):
+    # Activity is keyed by its ID, so events sharing a timestamp are all kept
+    output = row_buffer.RowBuffer(ACTIVITY_COLUMNS, ACTIVITY_TIMESTAMP_COLUMNS)
+    for activity in activities:
+        output.append(transform_activity(activity), activity_id(activity))
+    metrics.ROWS_EMITTED.labels("/project_activity").inc(len(output))
+
+    with timing.phase("serialisation"):
+        response = row_buffer.buffer_response(output, output_format, f"project-activity-{project_id}")
+    if state.get("cursor", None):
+        response.headers[ACTIVITY_CURSOR_HEADER] = state["cursor"]
+    return response
+
+
+def audit_settings(args):
+    """
+    Returns the project audit settings from request args, and an error response if they are invalid
+    """
+    # Either the project ID or its name and owner will do. Whichever is missing is looked up, and cached
+    if not "project_id" in args and not all(key in args for key in ("project_name","project_owner")):
         logging.error(f"No project details have been supplied. Args sent: {args}")
         error = {
-            "message": "Usage: /project_audit?project_name=<project_name>&project_owner=<project_owner>&project_id=<project_id>"
+            "message": "Usage: /project_audit?project_id=<project_id> or ?project_name=<project_name>&project_owner=<project_owner>"
         }
-        return make_response(error,400)
+        return None, make_response(error,400)
+
+    output_format = args.get('format', "json").lower()
+    if output_format not in OUTPUT_FORMATS:
+        error = {
+            "message": f"Unsupported format: {output_format}. Valid values: {', '.join(OUTPUT_FORMATS)}"
+        }
+        return None, make_response(error,400)
+
+    fields, error = None, None
+    create_links = args.get('links', "False").lower() == "true"
+    # columns is accepted as another name for fields
+    fields_arg = args.get('fields', None) or args.get('columns', None)
+    if fields_arg:
+        fields, error = report_fields(fields_arg, create_links)
+    filters, filter_error = job_filters(args)
+    error = error or filter_error
+    numbers, number_error = positive_int_args(args, {"page_size": 500, "page_number": 1,
+                                                     "thread_count": os.getenv("PROJECT_AUDIT_HTTP_THREAD_COUNT", 10)})
+    error = error or number_error
+    if not error and args.get('incremental', "False").lower() == "true" and (fields or filters):
+        error = "incremental cannot be combined with fields or filters"
+    if error:
+        return None, make_response({"message": error}, 400)
+
+    settings = {
+        "project_id": args.get('project_id', None),
+        "project_name": args.get('project_name', None),
+        "project_owner": args.get('project_owner', None),
+        "create_links": create_links,
+        "page_size": numbers["page_size"],
+        "page_number": numbers["page_number"],
+        "all_pages": args.get('all_pages', "False").lower() == "true",
+        "incremental": args.get('incremental', "False").lower() == "true",
+        "output_format": output_format,
+        "threads": numbers["thread_count"],
+        "refresh_cache": args.get('refresh_cache', "False").lower() == "true",
+        # Report columns to return, or None for all of them. Only the endpoints that feed them are called
+        "fields": fields,
+        "endpoints": job_data_endpoints(fields),
+        # Status, user and submission date filters, applied to the job listing before enrichment
+        "filters": filters,
+    }
+    return settings, None
+
+
+def select_fields(report_columns, fields):
+    """
+    Returns only the given report columns, or all of them if fields is None
+    """
+    if fields is None:
+        return report_columns
+    return {field: report_columns[field] for field in fields}
+
+
+def report_cache_key(settings):
+    """
+    Returns the cache key for a report. Settings that only change how the report is fetched or
+    serialised are left out, so requests for the same report share one entry.
+    """
+    key = tuple(settings[name] for name in ("project_id", "project_name", "project_owner", "create_links",
+                                            "page_size", "page_number", "all_pages"))
+    fields = tuple(settings["fields"]) if settings["fields"] is not None else None
+    return key + (fields, tuple(sorted((settings["filters"] or {}).items())))
+
+
+def cached_report(key, build_report, refresh=False):
+    """
+    Returns a report from the cache, or builds it. Concurrent requests for the same report
+    wait for the one already being built. Also returns hit, coalesced or miss.
+    """
+    if not refresh:
+        report = report_cache.get(key, None)
+        if report is not None:
+            return report, "hit"
+
+    def build_and_store():
+        report = build_report()
+        report_cache.set(key, report, weight=max(len(report[0]), 1))
+        return report
+
+    report, shared = report_flights.do(key, build_and_store)
+    if shared:
+        metrics.CACHE_LOOKUPS.labels(report_cache.name, "coalesced").inc()
+    return report, "coalesced" if shared else "miss"
+
+
+def main(auth_header, requesting_user, args=None):
+    t0 = datetime.datetime.now()
+    settings, error = audit_settings(args)
+    if error:
+        return error
+    with timing.phase("project_lookup"):
+        resolve_project(settings, auth_header)
+    if settings["refresh_cache"]:
+        invalidate_project_metadata(settings["project_id"])
+    project_id = settings["project_id"]
+    project_name = settings["project_name"]
+    project_owner = settings["project_owner"]
+    create_links = settings["create_links"]
+    page_size = settings["page_size"]
+    page_number = settings["page_number"]
+    all_pages = settings["all_pages"]
+    incremental = settings["incremental"]
+    output_format = settings["output_format"]
+    threads = settings["threads"]
+    fields = settings["fields"]
+    endpoints = settings["endpoints"]
+    filters = settings["filters"]
 
-    project_id = args.get('project_id', None)
-    project_name = args.get('project_name', None)
-    project_owner = args.get('project_owner', None)
-    create_links = args.get('links', "False")
-    page_size = args.get('page_size', 500)
-    page_number = args.get('page_number', 1)
-    create_links = True if create_links.lower() == "true" else False
-    threads = int(args.get('thread_count',os.getenv("PROJECT_AUDIT_HTTP_THREAD_COUNT",10)))
-    
     logging.info(f"Args sent: {args}")
     logging.info(f"{requesting_user} requested audit report for {project_name}...")
 
-    goals = get_goals(project_id, auth_header)
-    job_ids = get_jobs(project_id, auth_header, page_size, page_number)
-    logging.info(f"Found {len(job_ids)} jobs to report. Aggregating job metadata...")
-    logging.info(f"Attempting API queries using {threads} thread(s)...")
-    t = datetime.datetime.now()    
-    jobs = asyncio.run(aggregate_job_data(job_ids, project_id, auth_header, threads=threads))
-    t = datetime.datetime.now() - t
-    logging.info(f"Queries succeeded in {str(round(t.total_seconds(),1))} seconds.")     
-    report_data = generate_report(jobs,goals,project_name, project_owner, project_id, create_links, auth_header)
+    # thread_count is the ceiling, the limiter finds how much concurrency Nucleus can take below it
+    limiter = concurrency.AdaptiveLimiter(threads)
+    if output_format == "ndjson":
+        with timing.phase("goals"):
+            goals = get_goals(project_id, auth_header)
+        with timing.phase("install_config"):
+            domino_host = get_domino_host(auth_header)
+        logging.info(f"Streaming audit report using up to {threads} thread(s)...")
+        # Job listing and enrichment run while rows are written, so only the wait for each job is counted as enrichment
+        job_stream = timing.timed("enrichment", iterate_async(audit_job_stream(settings, auth_header, limiter)))
+        report = stream_report(job_stream, goals, project_name, project_owner, project_id, create_links, domino_host, fields)
+        return Response(timing.with_trailer(metrics.count_rows("/project_audit", report), "/project_audit"),
+                        mimetype="application/x-ndjson")
+
+    def build_report():
+        with timing.phase("goals"):
+            goals = get_goals(project_id, auth_header)
+        if all_pages or incremental:
+            logging.info(f"Paging through jobs from page {page_number}, {page_size} jobs per page...")
+            logging.info(f"Attempting API queries using up to {threads} thread(s)...")
+            t = datetime.datetime.now()
+            # Pages are listed while earlier ones are enriched, so listing is part of enrichment here
+            with timing.phase("enrichment"):
+                jobs = event_loop.run(collect_job_data(audit_job_stream(settings, auth_header, limiter)))
+            logging.info(f"Found {len(jobs)} jobs to report.")
+        else:
+            with timing.phase("job_listing"):
+                job_ids = get_jobs(project_id, auth_header, page_size, page_number, filters)
+            logging.info(f"Found {len(job_ids)} jobs to report. Aggregating job metadata...")
+            logging.info(f"Attempting API queries using up to {threads} thread(s)...")
+            t = datetime.datetime.now()
+            with timing.phase("enrichment"):
+                jobs = event_loop.run(aggregate_job_data(job_ids, project_id, auth_header, threads=threads, limiter=limiter,
+                                                      endpoints=endpoints, filters=filters))
+        t = datetime.datetime.now() - t
+        logging.info(f"Queries succeeded in {str(round(t.total_seconds(),1))} seconds.")     
+        with timing.phase("install_config"):
+            domino_host = get_domino_host(auth_header)
+        with timing.phase("report_build"):
+            job_ids, report_columns = report_pool.build_report_columns(jobs, goals, project_name, project_owner, project_id,
+                                                                       create_links, domino_host)
+            return job_ids, select_fields(report_columns, fields)
+
+    (job_ids, report_columns), cache_status = cached_report(report_cache_key(settings), build_report, settings["refresh_cache"])
+    headers = {REPORT_CACHE_HEADER: cache_status}
+    if cache_status == "miss":
+        headers.update(limiter.headers())
+    else:
+        logging.info(f"Audit report for {project_name} served from cache ({cache_status})")
+    metrics.ROWS_EMITTED.labels("/project_audit").inc(len(job_ids))
+    with timing.phase("serialisation"):
+        if output_format in formats.COLUMNAR_FORMATS:
+            table = formats.columns_to_table({"Job ID": job_ids, **report_columns})
+            response = formats.table_response(table, output_format, f"project-audit-{project_id}")
+            response.headers.update(headers)
+        else:
+            # Serialised as Flask would, but large reports are split across the report processes
+            response = Response(report_pool.columns_to_json(job_ids, report_columns) + "\n", mimetype="application/json",
+                                headers=headers)
+    t = datetime.datetime.now() - t0
     logging.info(f"Audit report generated in {str(round(t.total_seconds(),1))} seconds.")
-    return report_data
+    return response
+
+
+def shard_main(auth_header, requesting_user, body):
+    """
+    Enrich one shard of a sharded project audit for the replica coordinating it.
+    The shard's jobs are streamed back as newline delimited JSON, see sharding.shard_stream.
+    """
+    project_id = body.get("project_id", None)
+    job_ids = body.get("job_ids", None)
+    if not isinstance(project_id, str) or not isinstance(job_ids, list) or not all(isinstance(job_id, str) for job_id in job_ids):
+        return make_response({"message": "Expected a JSON body with project_id and a list of job_ids"}, 400)
+    if len(job_ids) > sharding.SHARD_MAX_JOBS:
+        return make_response({"message": f"{len(job_ids)} jobs sent, at most {sharding.SHARD_MAX_JOBS} are allowed"}, 400)
+    fields = None
+    if isinstance(body.get("fields", None), list):
+        fields, error = report_fields(",".join(body["fields"]), True)
+        if error:
+            return make_response({"message": error}, 400)
+    numbers, error = positive_int_args(body, {"thread_count": os.getenv("PROJECT_AUDIT_HTTP_THREAD_COUNT", 10)})
+    if error:
+        return make_response({"message": error}, 400)
+    threads = numbers["thread_count"]
+
+    # The caller's own credentials are forwarded, so shards are only served to those who can read the project
+    with timing.phase("access_check"):
+        check_project_access(project_id, auth_header)
+    logging.info(f"{requesting_user} sent a shard of {len(job_ids)} jobs from {project_id}")
+    limiter = concurrency.AdaptiveLimiter(threads)
+    job_stream = iterate_async(enrich_job_ids(project_id, job_ids, auth_header, threads, limiter, job_data_endpoints(fields)))
+    return Response(sharding.shard_stream(job_stream), mimetype="application/x-ndjson")
+
+
+def run_audit_job(auth_header, requesting_user, args, job):
+    """
+    Run a project audit as a background job, writing the report into the job's directory.
+    Progress is reported as jobs listed and jobs enriched so far.
+    """
+    # The args were validated when the job was submitted
+    settings, _ = audit_settings(args)
+    resolve_project(settings, auth_header)
+    project_id = settings["project_id"]
+    output_format = settings["output_format"]
+    logging.info(f"{requesting_user} started background audit {job.id} of {settings['project_name']}")
+
+    goals = get_goals(project_id, auth_header)
+    limiter = concurrency.AdaptiveLimiter(settings["threads"])
+
+    async def collect():
+        jobs = {}
+        job_stream = audit_job_stream(settings, auth_header, limiter, progress=job.report_progress)
+        async for job_data in job_stream:
+            jobs[job_data.get("id", None)] = job_data
+            job.report_progress(jobs_enriched=len(jobs))
+        return jobs
+
+    jobs = event_loop.run(collect())
+    job.report_progress(jobs_enriched=len(jobs))
+    job.status["metadata"] = limiter.summary()
+    domino_host = get_domino_host(auth_header)
+    job_ids, report_columns = report_pool.build_report_columns(jobs, goals, settings["project_name"], settings["project_owner"],
+                                                               project_id, settings["create_links"], domino_host)
+    report_columns = select_fields(report_columns, settings["fields"])
+
+    filename = f"project-audit-{project_id}.{output_format}"
+    if output_format in formats.COLUMNAR_FORMATS:
+        table = formats.columns_to_table({"Job ID": job_ids, **report_columns})
+        with open(job.path(filename), "wb") as f:
+            f.write(formats.write_table(table, output_format))
+        mimetype = formats.COLUMNAR_FORMATS[output_format]
+    elif output_format == "ndjson":
+        with open(job.path(filename), "w") as f:
+            for job_id, row in report_builder.columns_to_dict(job_ids, report_columns).items():
+                f.write(json.dumps({"Job ID": job_id, **row}) + "\n")
+        mimetype = "application/x-ndjson"
+    else:
+        with open(job.path(filename), "w") as f:
+            f.write(report_pool.columns_to_json(job_ids, report_columns))
+        mimetype = "application/json"
+    job.set_result(filename, mimetype)
+    metrics.ROWS_EMITTED.labels("/audit_jobs").inc(len(job_ids))
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
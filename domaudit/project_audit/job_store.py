@@ -0,0 +1,87 @@
+import os
+import json
+import time
+import logging
+import sqlite3
+import tempfile
+
+# Completed jobs never change, so their enriched data is kept locally and reused by incremental audits
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", os.path.join(tempfile.gettempdir(), "domaudit", "jobs.db"))
+
+# Set on jobs whose detail could not all be fetched. They are reported, but never stored.
+PARTIAL_KEY = "_partial"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    project_id TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    job_number INTEGER,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (project_id, job_id)
+);
+"""
+
+_initialised = False
+
+
+def connect():
+    """
+    Open a connection to the job store, creating the database on first use
+    """
+    global _initialised
+    if not _initialised:
+        os.makedirs(os.path.dirname(JOB_STORE_PATH) or ".", exist_ok=True)
+    conn = sqlite3.connect(JOB_STORE_PATH, timeout=30)
+    if not _initialised:
+        # WAL lets every gunicorn worker read while another one writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        _initialised = True
+        logging.info(f"Job store opened at {JOB_STORE_PATH}")
+    return conn
+
+
+def is_completed(job):
+    statuses = job.get("statuses", None) or {}
+    return bool(statuses.get("isCompleted", False))
+
+
+def get_completed_jobs(project_id, job_ids):
+    """
+    Returns stored data for the completed jobs in job_ids, keyed by job ID
+    """
+    jobs = {}
+    if not job_ids:
+        return jobs
+    conn = connect()
+    try:
+        # Stay well under sqlite's bound parameter limit
+        for i in range(0, len(job_ids), 500):
+            chunk = job_ids[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(f"SELECT job_id, data FROM jobs WHERE project_id = ? AND job_id IN ({placeholders})",
+                                [project_id, *chunk])
+            for job_id, data in rows:
+                jobs[job_id] = json.loads(data)
+    finally:
+        conn.close()
+    return jobs
+
+
+def save_jobs(project_id, jobs):
+    """
+    Store the completed jobs from a list of enriched jobs. Jobs still running, or only partly fetched, are skipped.
+    """
+    now = time.time()
+    rows = [(project_id, job.get("id", None), job.get("number", None), json.dumps(job), now)
+            for job in jobs if job.get("id", None) and is_completed(job) and not job.get(PARTIAL_KEY, False)]
+    if not rows:
+        return 0
+    conn = connect()
+    try:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO jobs (project_id, job_id, job_number, data, updated_at) VALUES (?, ?, ?, ?, ?)", rows)
+    finally:
+        conn.close()
+    return len(rows)
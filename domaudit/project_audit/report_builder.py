@@ -0,0 +1,184 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+# Columns holding epoch millisecond timestamps, converted together once every job has been read
+TIMESTAMP_COLUMNS = ("Submission Time", "Run Start Time", "Completed Time")
+
+
+def to_datetimes(epoch_ms):
+    """
+    Convert a list of epoch millisecond timestamps to UTC datetimes in one pass. None becomes NaT.
+    """
+    return pd.to_datetime(pd.array(epoch_ms, dtype="Int64"), unit="ms", utc=True)
+
+
+def format_timestamps(datetimes):
+    """
+    Format UTC datetimes the same way as job_audit.convert_datetime, without a strftime call per value
+    """
+    values = np.asarray(pd.DatetimeIndex(datetimes).tz_localize(None), dtype="datetime64[us]")
+    return [None if s == "NaT" else f"{s[:10]} {s[11:19]}:{s[20:]} UTC"
+            for s in np.datetime_as_string(values, unit="us")]
+
+
+def build_report_columns(jobs, goals, project_name, project_owner, project_id, create_links, domino_host):
+    """
+    Returns the job IDs and the project audit report as a dictionary of column lists.
+    Fields are read straight into the columns, and timestamp columns are converted
+    to UTC datetimes in one pass. The columns and values match job_audit.generate_job_report.
+    """
+    job_ids = list(jobs)
+    comments_col = []
+    repos_col = []
+    datasets_col = []
+    volumes_col = []
+    goals_col = []
+    number_col = []
+    commit_col = []
+    results_url_col = []
+    main_repo_url_col = []
+    command_col = []
+    hardware_col = []
+    username_col = []
+    status_col = []
+    submission_col = []
+    run_start_col = []
+    completed_col = []
+    env_name_col = []
+    env_version_col = []
+    completed_flag_col = []
+    archived_flag_col = []
+    scheduled_flag_col = []
+    # Comment timestamps are nested, so remember where each one goes and fill them in afterwards
+    comment_times = []
+    comment_rows = []
+
+    for job_id in job_ids:
+        job_data = jobs[job_id]
+
+        comments = []
+        for comment_details in job_data.get("comments", None) or ():
+            comment = {
+                'comment-username': comment_details.get("commenter", None).get("username", None),
+                'comment-timestamp': None,
+                'comment-value': comment_details.get("commentBody", None).get("value", None)
+            }
+            comment_times.append(comment_details.get("created", 0))
+            comment_rows.append(comment)
+            comments.append(comment)
+        comments_col.append(comments)
+
+        repos_col.append([{
+            "Repo URI": repo.get("uri", None),
+            "Starting Branch": repo.get("startingBranch", None),
+            "Starting Commit ID ": repo.get("startingCommitId", None) ,
+            "Starting Commit URI ": repo.get("startingCommitUri", None)
+        } for repo in job_data.get("dependentRepositories", None) or ()])
+
+        datasets_col.append([{
+            "Dataset Name": dataset.get("datasetName", None),
+            "Dataset Snapshot version": dataset.get("snapshotVersion", None)
+        } for dataset in job_data.get("dependentDatasetMounts", None) or ()])
+
+        volumes = []
+        for volume in job_data.get("dependentExternalVolumeMounts", None) or ():
+            volume_info = {
+                "Volume Name": volume.get("name", None)
+            }
+            if volume.get("mount",None):
+                volume_info["Volume Mount Point"] = volume.get("mount").get("mountPath",None)
+                volume_info["Volume Read Only"] = volume.get("mount").get("readOnly",None)
+            volumes.append(volume_info)
+        volumes_col.append(volumes)
+
+        goals_col.append([goals[goal_id] for goal_id in job_data.get("goalIds", None) or ()])
+        number_col.append(job_data.get("number", None))
+
+        end_state = job_data.get("endState", None)
+        end_state_commit = end_state.get("commitId", None) if end_state else None
+        commit_col.append(end_state_commit)
+
+        if create_links:
+            main_repo = job_data.get("mainRepo", None)
+            if main_repo:
+                main_repo_commit_url = main_repo.get("commitResourceLink", None)
+            else:
+                main_repo_commit = job_data.get("commitDetails", {}).get("inputCommitId", None)
+                if main_repo_commit:
+                    main_repo_commit_url = f"{domino_host}/u/{project_owner}/{project_name}/browse?commitId={main_repo_commit}"
+                else:
+                    main_repo_commit_url = None
+            results_url_col.append(f"{domino_host}/u/{project_owner}/{project_name}/browse?commitId={end_state_commit}")
+            main_repo_url_col.append(main_repo_commit_url)
+
+        command_col.append(job_data.get("jobRunCommand", None))
+        hardware_col.append(job_data.get("hardwareTier", None))
+        username_col.append(job_data.get("startedBy", None).get("username", None))
+        statuses = job_data.get("statuses", None)
+        status_col.append(statuses.get("executionStatus", None))
+        stage_time = job_data.get("stageTime", 0)
+        submission_col.append(stage_time.get("submissionTime", 0))
+        run_start_col.append(stage_time.get("runStartTime", None) or None)
+        completed_col.append(stage_time.get("completedTime", 0))
+        environment = job_data.get("environment", None)
+        env_name_col.append(environment.get("environmentName", None))
+        env_version_col.append(environment.get("revisionNumber", None))
+        completed_flag_col.append(statuses.get("isCompleted", None))
+        archived_flag_col.append(statuses.get("isArchived", None))
+        scheduled_flag_col.append(statuses.get("isScheduled", None))
+
+    for comment, timestamp in zip(comment_rows, format_timestamps(to_datetimes(comment_times))):
+        comment['comment-timestamp'] = timestamp
+
+    columns = {
+        'Comments': comments_col,
+        'Linked Repos': repos_col,
+        'Datasets': datasets_col,
+        'External Volumes': volumes_col,
+        'Goals': goals_col,
+        'Job Number': number_col,
+        'Project Name': [project_name] * len(job_ids),
+        "Commit ID": commit_col,
+    }
+    if create_links:
+        columns["Results Commit URL"] = results_url_col
+        columns["Main Repo Commit URL"] = main_repo_url_col
+        columns["Audit URL"] = [f"{domino_host}/projects/{project_id}/auditLog"] * len(job_ids)
+    columns.update({
+        "Command": command_col,
+        "Hardware Tier": hardware_col,
+        "Username": username_col,
+        "Execution Status": status_col,
+        "Submission Time": submission_col,
+        "Run Start Time": run_start_col,
+        "Completed Time": completed_col,
+        "Environment Name": env_name_col,
+        "Environment Version": env_version_col,
+        "Execution Status Completed": completed_flag_col,
+        "Execution Status Archived": archived_flag_col,
+        "Execution Status Scheduled": scheduled_flag_col,
+    })
+
+    for name in TIMESTAMP_COLUMNS:
+        columns[name] = to_datetimes(columns[name])
+    return job_ids, columns
+
+
+def columns_to_dict(job_ids, columns):
+    """
+    Returns report columns as a dictionary of rows keyed by job ID, with formatted timestamps
+    """
+    names = list(columns)
+    values = [format_timestamps(columns[name]) if name in TIMESTAMP_COLUMNS else columns[name] for name in names]
+    # A report of job IDs alone has no columns to zip
+    rows = zip(*values) if values else ((),) * len(job_ids)
+    return {job_id: dict(zip(names, row)) for job_id, row in zip(job_ids, rows)}
+
+
+def rows_json(job_ids, columns):
+    """
+    Returns columns_to_dict as JSON text, with the same sorted keys and compact separators as a Flask response
+    """
+    return json.dumps(columns_to_dict(job_ids, columns), sort_keys=True, separators=(",", ":"))
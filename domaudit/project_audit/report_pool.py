@@ -0,0 +1,118 @@
+import os
+import atexit
+import logging
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from domaudit.project_audit import report_builder
+
+# Processes per worker that build and serialise large reports, so the worker's threads stay
+# responsive while a big audit is formatted. 0 builds every report in the worker itself.
+# Each process imports pandas, numpy and pyarrow, about 120 MB, and the worker still pickles
+# every chunk and merges the results, so the pool only pays with spare cores and memory
+REPORT_PROCESSES = int(os.getenv("REPORT_PROCESSES", 0))
+# Reports with fewer jobs than this are built in the worker, as handing them over would cost more than it saves
+REPORT_PROCESS_MIN_JOBS = int(os.getenv("REPORT_PROCESS_MIN_JOBS", 20000))
+# Jobs in each chunk handed to a process
+REPORT_CHUNK_JOBS = int(os.getenv("REPORT_CHUNK_JOBS", 5000))
+
+_pool = None
+_pool_pid = None
+_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns this worker's process pool, creating it on first use.
+    Processes are spawned rather than forked, as the worker already runs threads and an event loop.
+    """
+    global _pool, _pool_pid
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=REPORT_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+            _pool_pid = os.getpid()
+            atexit.register(_pool.shutdown, cancel_futures=True)
+            logging.info(f"Started report process pool of {REPORT_PROCESSES} process(es) for worker {os.getpid()}")
+        return _pool
+
+
+def discard_pool():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def use_pool(jobs):
+    return REPORT_PROCESSES > 0 and jobs >= REPORT_PROCESS_MIN_JOBS
+
+
+def chunks(items, size=REPORT_CHUNK_JOBS):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def run_chunks(fn, chunk_args):
+    """
+    Returns fn's result for each chunk, in chunk order, computed in the process pool.
+    Returns None if the pool broke, for the caller to do the work itself.
+    """
+    try:
+        return list(get_pool().map(fn, *zip(*chunk_args)))
+    except BrokenProcessPool as e:
+        logging.error(f"Report process pool failed, building the report in the worker: {e!r}")
+        discard_pool()
+        return None
+
+
+def merge_columns(results):
+    """
+    Join the job IDs and columns built for each chunk, in chunk order
+    """
+    job_ids = list(itertools.chain.from_iterable(chunk_ids for chunk_ids, _ in results))
+    first = results[0][1]
+    columns = {}
+    for name in first:
+        if name in report_builder.TIMESTAMP_COLUMNS:
+            columns[name] = first[name].append([chunk_columns[name] for _, chunk_columns in results[1:]])
+        else:
+            columns[name] = list(itertools.chain.from_iterable(chunk_columns[name] for _, chunk_columns in results))
+    return job_ids, columns
+
+
+def build_report_columns(jobs, goals, project_name, project_owner, project_id, create_links, domino_host):
+    """
+    report_builder.build_report_columns, with large reports built in chunks by the process pool and merged in order
+    """
+    if not use_pool(len(jobs)):
+        return report_builder.build_report_columns(jobs, goals, project_name, project_owner, project_id, create_links, domino_host)
+    job_chunks = [{job_id: jobs[job_id] for job_id in chunk} for chunk in chunks(list(jobs))]
+    logging.info(f"Building a report of {len(jobs)} jobs in {len(job_chunks)} chunk(s) across {REPORT_PROCESSES} process(es)")
+    results = run_chunks(report_builder.build_report_columns,
+                         [(chunk, goals, project_name, project_owner, project_id, create_links, domino_host) for chunk in job_chunks])
+    if results is None:
+        return report_builder.build_report_columns(jobs, goals, project_name, project_owner, project_id, create_links, domino_host)
+    return merge_columns(results)
+
+
+def columns_to_json(job_ids, columns):
+    """
+    Returns report columns as the JSON text of report_builder.columns_to_dict. Large reports are
+    serialised in chunks by the process pool, in job ID order, and joined into one object.
+    """
+    if not use_pool(len(job_ids)):
+        return report_builder.rows_json(job_ids, columns)
+    # Chunks follow job ID order, so the sorted objects they serialise join into one sorted object
+    order = sorted(range(len(job_ids)), key=job_ids.__getitem__)
+    chunk_args = []
+    for chunk in chunks(order):
+        chunk_columns = {name: values[chunk] if name in report_builder.TIMESTAMP_COLUMNS else [values[i] for i in chunk]
+                         for name, values in columns.items()}
+        chunk_args.append(([job_ids[i] for i in chunk], chunk_columns))
+    fragments = run_chunks(report_builder.rows_json, chunk_args)
+    if fragments is None:
+        return report_builder.rows_json(job_ids, columns)
+    return "{" + ",".join(fragment[1:-1] for fragment in fragments if fragment != "{}") + "}"
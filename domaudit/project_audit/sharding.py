@@ -0,0 +1,229 @@
+import os
+import json
+import random
+import socket
+import asyncio
+import logging
+import time
+
+from aiohttp import ClientSession, ClientTimeout, ClientError, TCPConnector, DummyCookieJar
+from aiohttp.http_exceptions import HttpProcessingError
+
+from domaudit.services import metrics
+
+# Split audits with many jobs into shards, enriched by the other replicas of the deployment
+SHARDING_ENABLED = os.getenv("SHARDING_ENABLED", "false").lower() == "true"
+# Headless service whose DNS name resolves to the address of every ready replica, and the port they serve on
+SHARD_PEERS_SERVICE = os.getenv("SHARD_PEERS_SERVICE", "")
+SHARD_PEER_PORT = int(os.getenv("SHARD_PEER_PORT", os.getenv("FLASK_RUN_PORT", 5000)))
+# Audits listing fewer jobs than this are enriched locally
+SHARD_MIN_JOBS = int(os.getenv("SHARD_MIN_JOBS", 5000))
+# Jobs per shard
+SHARD_SIZE = int(os.getenv("SHARD_SIZE", 1000))
+# Shards in flight on each replica at once
+SHARD_PARALLEL_PER_PEER = int(os.getenv("SHARD_PARALLEL_PER_PEER", 1))
+# Replicas a shard is tried on before the coordinator enriches it itself
+SHARD_ATTEMPTS = int(os.getenv("SHARD_ATTEMPTS", 3))
+# Seconds a shard's response may go quiet before the replica is given up on
+SHARD_READ_TIMEOUT_SECONDS = float(os.getenv("SHARD_READ_TIMEOUT_SECONDS", 300))
+# Most jobs a shard request may carry
+SHARD_MAX_JOBS = int(os.getenv("SHARD_MAX_JOBS", 10000))
+# Longest line of job data a replica may send back, in bytes
+SHARD_MAX_LINE_BYTES = int(os.getenv("SHARD_MAX_LINE_BYTES", 16 * 1024 * 1024))
+
+SHARD_PATH = "/internal/project_audit_shard"
+SHARD_ENDPOINT = "internal/project_audit_shard"
+
+
+class ShardError(Exception):
+    """
+    A replica failed to return a complete shard
+    """
+
+
+def enabled():
+    return SHARDING_ENABLED and bool(SHARD_PEERS_SERVICE)
+
+
+async def discover_peers():
+    """
+    Returns the addresses of every ready replica, including this one, from the headless service.
+    An empty list means sharding is not possible right now.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        addresses = await loop.getaddrinfo(SHARD_PEERS_SERVICE, SHARD_PEER_PORT, type=socket.SOCK_STREAM)
+    except OSError as e:
+        logging.warning(f"Could not resolve shard peers from {SHARD_PEERS_SERVICE}: {e}")
+        return []
+    return sorted({address[4][0] for address in addresses})
+
+
+def split_shards(job_ids, shard_size=SHARD_SIZE):
+    return [job_ids[i:i + shard_size] for i in range(0, len(job_ids), shard_size)]
+
+
+def shard_threads(threads, peers):
+    """
+    Returns the threads each shard in flight is enriched with. Every replica applies its own
+    concurrency ceiling, so the audit's threads are divided between the shards running at once.
+    """
+    return max(1, threads // (len(peers) * SHARD_PARALLEL_PER_PEER))
+
+
+async def iter_lines(content, max_line_bytes=SHARD_MAX_LINE_BYTES):
+    """
+    Yield the lines of a response body. A line longer than max_line_bytes ends the shard,
+    rather than relying on the limit of the client's own line reader.
+    """
+    buffer = bytearray()
+    async for chunk in content.iter_any():
+        buffer.extend(chunk)
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            yield bytes(buffer[start:end])
+            start = end + 1
+        del buffer[:start]
+        if len(buffer) > max_line_bytes:
+            raise ShardError(f"Line of over {max_line_bytes} bytes")
+    if buffer:
+        yield bytes(buffer)
+
+
+def peer_url(peer):
+    host = f"[{peer}]" if ":" in peer else peer
+    return f"http://{host}:{SHARD_PEER_PORT}{SHARD_PATH}"
+
+
+async def fetch_shard(session, peer, payload, auth_header):
+    """
+    Returns the job data a replica enriched for one shard. The response is newline delimited JSON,
+    ending with a line that counts the jobs, so a stream cut short is never taken as complete.
+    """
+    t = time.monotonic()
+    status = None
+    try:
+        async with session.post(peer_url(peer), json=payload, headers=auth_header) as response:
+            status = response.status
+            if status != 200:
+                raise ShardError(f"{peer} returned {status}: {(await response.text())[:200]}")
+            jobs = []
+            async for line in iter_lines(response.content):
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                if "shard" in item:
+                    if item["shard"]["jobs"] != len(jobs):
+                        raise ShardError(f"{peer} returned {len(jobs)} of {item['shard']['jobs']} jobs")
+                    return jobs
+                jobs.append(item)
+            raise ShardError(f"{peer} ended the shard after {len(jobs)} jobs")
+    except (ClientError, HttpProcessingError, asyncio.TimeoutError, ValueError) as e:
+        raise ShardError(f"{peer} failed: {e!r}") from e
+    finally:
+        metrics.observe_upstream(SHARD_ENDPOINT, time.monotonic() - t, status)
+
+
+async def stream_shards(job_ids, peers, payload, auth_header, enrich_locally):
+    """
+    Yield job data for job_ids, enriched in shards by the given replicas.
+    A shard that fails is tried again on a replica it has not been tried on, and after SHARD_ATTEMPTS
+    failures is enriched here instead, by the async generator enrich_locally(job_ids) returns.
+    Shards are yielded whole, so a shard retried after a partial response never repeats a job.
+    """
+    shards = asyncio.Queue()
+    for shard in split_shards(job_ids):
+        shards.put_nowait((shard, set()))
+    remaining = shards.qsize()
+    dispatchers = len(peers) * SHARD_PARALLEL_PER_PEER
+    done = asyncio.Queue(maxsize=dispatchers)
+    finished = object()
+    # Put on the shard queue once per dispatcher when every shard is done, as retried shards are put back on it
+    stop = object()
+
+    def stop_dispatchers():
+        for _ in range(dispatchers):
+            shards.put_nowait(stop)
+
+    if not remaining:
+        stop_dispatchers()
+    # Replicas that have failed a shard are only given more if no other can take it
+    failed_peers = set()
+    # Start each audit on a different replica, so concurrent coordinators spread their first shards
+    offset = random.randrange(len(peers))
+
+    def choose_peer(tried, n):
+        candidates = [peer for peer in peers if peer not in tried]
+        healthy = [peer for peer in candidates if peer not in failed_peers]
+        candidates = healthy or candidates
+        return candidates[(offset + n) % len(candidates)] if candidates else None
+
+    async def dispatcher(session, n):
+        nonlocal remaining
+        while True:
+            item = await shards.get()
+            if item is stop:
+                return
+            shard, tried = item
+            peer = choose_peer(tried, n) if len(tried) < SHARD_ATTEMPTS else None
+            if peer is None:
+                logging.warning(f"Shard of {len(shard)} jobs failed on {len(tried)} replica(s), enriching it locally")
+                metrics.SHARDS.labels("local").inc()
+                jobs = [job async for job in enrich_locally(shard)]
+            else:
+                try:
+                    jobs = await fetch_shard(session, peer, {**payload, "job_ids": shard}, auth_header)
+                except ShardError as e:
+                    logging.warning(f"Shard of {len(shard)} jobs failed, retrying on another replica: {e}")
+                    metrics.SHARDS.labels("retried").inc()
+                    failed_peers.add(peer)
+                    tried.add(peer)
+                    shards.put_nowait((shard, tried))
+                    continue
+                metrics.SHARDS.labels("ok").inc()
+            remaining -= 1
+            if not remaining:
+                stop_dispatchers()
+            await done.put(jobs)
+
+    async def run(session, n):
+        try:
+            await dispatcher(session, n)
+        except Exception as e:
+            await done.put(e)
+        finally:
+            await done.put(finished)
+
+    logging.info(f"Sharding {len(job_ids)} jobs into {shards.qsize()} shard(s) across {len(peers)} replica(s)")
+    timeout = ClientTimeout(total=None, sock_read=SHARD_READ_TIMEOUT_SECONDS)
+    async with ClientSession(connector=TCPConnector(limit=len(peers) * SHARD_PARALLEL_PER_PEER),
+                             timeout=timeout, cookie_jar=DummyCookieJar()) as session:
+        tasks = [asyncio.create_task(run(session, n)) for n in range(dispatchers)]
+        try:
+            running = len(tasks)
+            while running:
+                item = await done.get()
+                if item is finished:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    for job in item:
+                        yield job
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def shard_stream(job_stream):
+    """
+    Yield a shard's job data as newline delimited JSON, ending with the count of jobs sent
+    """
+    jobs = 0
+    for job in job_stream:
+        jobs += 1
+        yield json.dumps(job) + "\n"
+    yield json.dumps({"shard": {"jobs": jobs}}) + "\n"
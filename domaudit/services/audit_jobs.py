@@ -0,0 +1,183 @@
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import logging
+import tempfile
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# Background audits can be turned off, for deployments of several replicas without a volume they all share
+AUDIT_JOBS_ENABLED = os.getenv("AUDIT_JOBS_ENABLED", "true").lower() == "true"
+# Background audits keep their status and result here. Every worker of a pod can serve them, and with more
+# than one replica this must be a volume shared by every pod, or polls reaching another pod get a 404
+AUDIT_JOB_DIR = os.getenv("AUDIT_JOB_DIR", os.path.join(tempfile.gettempdir(), "domaudit", "audit_jobs"))
+# Audits run at once by each worker process. Further submissions wait in the queue
+AUDIT_JOB_WORKERS = int(os.getenv("AUDIT_JOB_WORKERS", 2))
+# Seconds a finished audit and its result are kept before being deleted
+AUDIT_JOB_RESULT_TTL_SECONDS = float(os.getenv("AUDIT_JOB_RESULT_TTL_SECONDS", 86400))
+# Seconds between writes of a running audit's progress
+AUDIT_JOB_HEARTBEAT_SECONDS = 5
+# A running audit that has not written its progress for this long was lost with its worker
+AUDIT_JOB_STALE_SECONDS = float(os.getenv("AUDIT_JOB_STALE_SECONDS", 300))
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+_executor = None
+_executor_pid = None
+
+
+def get_executor():
+    """
+    Returns the executor running background audits in this worker process
+    """
+    global _executor, _executor_pid
+    # gunicorn forks workers, and an executor's threads do not survive a fork
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=AUDIT_JOB_WORKERS, thread_name_prefix="audit-job")
+        _executor_pid = os.getpid()
+    return _executor
+
+
+class AuditJob:
+    """
+    A background audit. Its state lives in a status file next to its result,
+    so it can be polled and downloaded through any worker.
+    """
+
+    def __init__(self, status):
+        self.status = status
+        self._saved_at = 0
+
+    @property
+    def id(self):
+        return self.status["id"]
+
+    def path(self, name):
+        return os.path.join(AUDIT_JOB_DIR, self.id, name)
+
+    def save(self):
+        self.status["updated_at"] = time.time()
+        os.makedirs(os.path.dirname(self.path("status.json")), exist_ok=True)
+        # Write then rename, so a poll never reads a half written file
+        tmp_path = self.path(f"status.json.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.status, f)
+        os.replace(tmp_path, self.path("status.json"))
+        self._saved_at = time.monotonic()
+
+    def report_progress(self, **progress):
+        """
+        Record progress counts. They are written out every few seconds, which doubles as the heartbeat.
+        """
+        self.status["progress"].update(progress)
+        if time.monotonic() - self._saved_at >= AUDIT_JOB_HEARTBEAT_SECONDS:
+            self.save()
+
+    def set_result(self, filename, mimetype):
+        self.status["result"] = {"filename": filename, "mimetype": mimetype,
+                                 "size": os.path.getsize(self.path(filename))}
+
+    def is_expired(self):
+        # Jobs that never finished, such as ones queued on a worker that restarted, expire from their last update
+        last_change = self.status.get("finished_at", None) or self.status.get("updated_at", None) or self.status["submitted_at"]
+        return time.time() - last_change > AUDIT_JOB_RESULT_TTL_SECONDS
+
+    def describe(self):
+        """
+        Returns the status reported to the user, without the owner or the internal result path
+        """
+        result = self.status.get("result", None)
+        return {
+            "id": self.id,
+            "audit": self.status["audit"],
+            "status": self.status["status"],
+            "progress": self.status["progress"],
+            "submitted_at": self.status["submitted_at"],
+            "started_at": self.status.get("started_at", None),
+            "finished_at": self.status.get("finished_at", None),
+            "error": self.status.get("error", None),
+            "metadata": self.status.get("metadata", None),
+            "result": {"mimetype": result["mimetype"], "size": result["size"]} if result else None,
+        }
+
+
+def run(job, runner):
+    job.status.update(status=RUNNING, started_at=time.time())
+    job.save()
+    try:
+        runner(job)
+        job.status["status"] = SUCCEEDED
+    except Exception as e:
+        logging.error(f"Background audit {job.id} failed: {e}\n{traceback.format_exc()}")
+        job.status.update(status=FAILED, error=str(e))
+    job.status["finished_at"] = time.time()
+    job.save()
+    logging.info(f"Background audit {job.id} {job.status['status']} in {round(job.status['finished_at'] - job.status['started_at'], 1)} seconds")
+
+
+def submit(audit, owner, params, runner):
+    """
+    Queue an audit to run in the background. runner(job) writes the result into the job's directory
+    and calls job.set_result. Returns the new job.
+    """
+    cleanup_expired()
+    job = AuditJob({
+        "id": uuid.uuid4().hex,
+        "audit": audit,
+        "owner": owner,
+        "params": params,
+        "status": QUEUED,
+        "progress": {},
+        "submitted_at": time.time(),
+    })
+    job.save()
+    get_executor().submit(run, job, runner)
+    logging.info(f"Queued background {audit} {job.id} for {owner}")
+    return job
+
+
+def get_job(job_id):
+    """
+    Returns a job by ID, or None if it does not exist or has expired
+    """
+    if not JOB_ID_PATTERN.match(job_id or ""):
+        return None
+    try:
+        with open(os.path.join(AUDIT_JOB_DIR, job_id, "status.json")) as f:
+            job = AuditJob(json.load(f))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if job.is_expired():
+        return None
+    if job.status["status"] == RUNNING and time.time() - job.status["updated_at"] > AUDIT_JOB_STALE_SECONDS:
+        job.status.update(status=FAILED, error="The audit stopped reporting progress, its worker may have restarted",
+                          finished_at=time.time())
+        job.save()
+    return job
+
+
+def cleanup_expired():
+    """
+    Delete the status and result of every job last changed more than AUDIT_JOB_RESULT_TTL_SECONDS ago
+    """
+    if not os.path.isdir(AUDIT_JOB_DIR):
+        return
+    for job_id in os.listdir(AUDIT_JOB_DIR):
+        if not JOB_ID_PATTERN.match(job_id):
+            continue
+        try:
+            with open(os.path.join(AUDIT_JOB_DIR, job_id, "status.json")) as f:
+                job = AuditJob(json.load(f))
+        except (FileNotFoundError, NotADirectoryError, json.JSONDecodeError):
+            continue
+        if job.is_expired():
+            shutil.rmtree(os.path.join(AUDIT_JOB_DIR, job_id), ignore_errors=True)
+            logging.info(f"Deleted expired background audit {job_id}")
@@ -0,0 +1,173 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from domaudit.services import metrics
+
+# All caches created in this process, by name, so their counters can be reported
+CACHES = {}
+
+_MISSING = object()
+
+
+def credential_key(auth_header):
+    """
+    Returns a hash of the credentials in an auth header, so raw credentials are never used as cache keys
+    """
+    credential = "\n".join(f"{k}={v}" for k, v in sorted(auth_header.items()))
+    return hashlib.sha256(credential.encode("utf-8")).hexdigest()
+
+
+class TTLCache:
+    """
+    Thread safe, size bounded cache with least recently used eviction.
+    Entries expire ttl seconds after they were set. If max_weight is set, entries are
+    also evicted until the total weight given to set is within it.
+    """
+
+    def __init__(self, name, max_size, ttl, max_weight=None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+        CACHES[name] = self
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                metrics.CACHE_LOOKUPS.labels(self.name, "miss").inc()
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            metrics.CACHE_LOOKUPS.labels(self.name, "hit").inc()
+            return entry[1]
+
+    def set(self, key, value, ttl=None, weight=1):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        if self.max_weight is not None and weight > self.max_weight:
+            # Would evict everything else and still not fit
+            return
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires, value, weight)
+            self.weight += weight
+            while len(self._entries) > self.max_size or (self.max_weight is not None and self.weight > self.max_weight):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_load(self, key, load, ttl=None):
+        """
+        Returns the value cached for key, or calls load() and caches its result.
+        Concurrent misses for the same key share a single call to load.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        def load_and_store():
+            value = load()
+            self.set(key, value, ttl)
+            return value
+
+        value, shared = self._flights.do(key, load_and_store)
+        if shared:
+            metrics.CACHE_LOOKUPS.labels(self.name, "coalesced").inc()
+        return value
+
+    def _remove(self, key):
+        self.weight -= self._entries.pop(key)[2]
+
+    def invalidate(self, key=None):
+        """
+        Drop one entry, or every entry if no key is given
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self.weight = 0
+            elif key in self._entries:
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "weight": self.weight,
+                "max_weight": self.max_weight,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Callers asking for a key that is already
+    being computed wait for that call and share its result, or its exception.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """
+        Returns fn()'s result, and whether it came from a call another caller started
+        """
+        with self._lock:
+            call = self._calls.get(key, None)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+            else:
+                self.coalesced += 1
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"], True
+        try:
+            call["result"] = fn()
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+        return call["result"], False
+
+
+def cache_stats():
+    return {name: c.stats() for name, c in CACHES.items()}
+
+
+def invalidate_caches(name=None):
+    """
+    Empty the named cache, or every cache if no name is given. Returns the names of the caches emptied.
+    Caches are per process, so under gunicorn this only reaches the worker serving the request.
+    """
+    names = [name] if name else list(CACHES)
+    for cache_name in names:
+        CACHES[cache_name].invalidate()
+    return names
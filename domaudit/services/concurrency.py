@@ -0,0 +1,133 @@
+import os
+import time
+import asyncio
+import logging
+
+# Adapt enrichment concurrency to how Nucleus is coping. When disabled, the requested thread count is used as is
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "true").lower() == "true"
+# Concurrency an audit starts at, before it has seen any latencies
+ADAPTIVE_CONCURRENCY_INITIAL = int(os.getenv("ADAPTIVE_CONCURRENCY_INITIAL", 4))
+# Smoothed latency above baseline * tolerance counts as Nucleus slowing down
+ADAPTIVE_LATENCY_TOLERANCE = float(os.getenv("ADAPTIVE_LATENCY_TOLERANCE", 2.0))
+# Fraction of the limit kept when backing off
+ADAPTIVE_DECREASE_FACTOR = 0.5
+# Weight of the newest latency in the moving average
+LATENCY_SMOOTHING = 0.2
+# Statuses that mean Nucleus is overloaded, rather than that the request was wrong
+OVERLOAD_STATUSES = {429, 502, 503, 504}
+
+
+class AdaptiveLimiter:
+    """
+    Additive increase, multiplicative decrease limit on concurrent work.
+    Every upstream call is reported to observe. While calls succeed and the smoothed latency
+    stays near the lowest seen, the limit grows by about one per limit's worth of calls.
+    An overload status, a failed call or a latency spike halves it, at most once per
+    smoothed round trip so one burst of errors only counts once.
+    The limit never goes above ceiling, the concurrency the caller asked for.
+    """
+
+    def __init__(self, ceiling, initial=ADAPTIVE_CONCURRENCY_INITIAL, adaptive=ADAPTIVE_CONCURRENCY):
+        self.ceiling = max(ceiling, 1)
+        self.adaptive = adaptive
+        self.limit = float(min(max(initial, 1), self.ceiling)) if adaptive else float(self.ceiling)
+        self.peak = self.limit
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.increases = 0
+        self.decreases = 0
+        self.smoothed_latency = None
+        self.baseline_latency = None
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.release()
+
+    def observe(self, elapsed, status):
+        """
+        Record one upstream call. status is None if no response was received.
+        """
+        self.calls += 1
+        if status is None or status in OVERLOAD_STATUSES:
+            self.errors += 1
+            self._decrease(f"status {status}" if status else "failed call")
+            return
+        if self.smoothed_latency is None:
+            self.smoothed_latency = elapsed
+        else:
+            self.smoothed_latency += LATENCY_SMOOTHING * (elapsed - self.smoothed_latency)
+        # Let the baseline drift up slowly, so a permanently slower Nucleus is not treated as overload forever
+        if self.baseline_latency is None or self.smoothed_latency < self.baseline_latency:
+            self.baseline_latency = self.smoothed_latency
+        else:
+            self.baseline_latency += 0.01 * (self.smoothed_latency - self.baseline_latency)
+
+        if self.smoothed_latency > self.baseline_latency * ADAPTIVE_LATENCY_TOLERANCE:
+            self._decrease(f"latency {round(self.smoothed_latency * 1000)}ms")
+        else:
+            self._increase()
+
+    def _increase(self):
+        if not self.adaptive or self.limit >= self.ceiling:
+            return
+        before = int(self.limit)
+        self.limit = min(self.ceiling, self.limit + 1 / self.limit)
+        if int(self.limit) > before:
+            self.increases += 1
+            self.peak = max(self.peak, self.limit)
+            logging.debug(f"Concurrency raised to {int(self.limit)}")
+            # Wake workers waiting for the extra slot
+            asyncio.get_running_loop().create_task(self._notify())
+
+    def _decrease(self, reason):
+        now = time.monotonic()
+        if not self.adaptive or now - self._last_decrease < (self.smoothed_latency or 0):
+            return
+        self._last_decrease = now
+        limit = max(1.0, self.limit * ADAPTIVE_DECREASE_FACTOR)
+        if int(limit) < int(self.limit):
+            self.decreases += 1
+            logging.debug(f"Concurrency lowered from {int(self.limit)} to {int(limit)} after {reason}")
+        self.limit = limit
+
+    async def _notify(self):
+        async with self._condition:
+            self._condition.notify_all()
+
+    def summary(self):
+        return {
+            "concurrency": int(self.limit),
+            "concurrency_peak": int(self.peak),
+            "concurrency_ceiling": self.ceiling,
+            "adaptive": self.adaptive,
+            "calls": self.calls,
+            "errors": self.errors,
+            "increases": self.increases,
+            "decreases": self.decreases,
+        }
+
+    def headers(self):
+        """
+        Response headers reporting the concurrency an audit ran at
+        """
+        return {
+            "X-Domaudit-Concurrency": str(int(self.limit)),
+            "X-Domaudit-Concurrency-Peak": str(int(self.peak)),
+            "X-Domaudit-Concurrency-Ceiling": str(self.ceiling),
+        }
@@ -0,0 +1,97 @@
+import os
+import asyncio
+import logging
+import threading
+import contextvars
+import concurrent.futures
+
+_loop = None
+_loop_pid = None
+_lock = threading.Lock()
+
+
+def get_loop():
+    """
+    Returns the asyncio event loop of this worker process, starting it on first use.
+    The loop runs for the life of the process in its own thread, and every request's
+    async work is scheduled on it, so concurrent audits share its connections.
+    """
+    global _loop, _loop_pid
+    with _lock:
+        # gunicorn forks workers, and a loop's thread does not survive a fork
+        if _loop is None or _loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="domaudit-event-loop", daemon=True).start()
+            logging.info(f"Started event loop for worker {os.getpid()}")
+            _loop = loop
+            _loop_pid = os.getpid()
+        return _loop
+
+
+def in_loop():
+    """
+    Returns whether the caller is running on this process's event loop
+    """
+    try:
+        return asyncio.get_running_loop() is _loop and _loop_pid == os.getpid()
+    except RuntimeError:
+        return False
+
+
+def submit(coro):
+    """
+    Schedule a coroutine on the worker's event loop from any other thread. Returns a concurrent.futures.Future.
+    The coroutine runs in a copy of the caller's context, so request state such as the timing breakdown follows it.
+    """
+    loop = get_loop()
+    context = contextvars.copy_context()
+    future = concurrent.futures.Future()
+
+    def start():
+        if not future.set_running_or_notify_cancel():
+            coro.close()
+            return
+        # A task runs in a copy of the context it was created in
+        task = context.run(loop.create_task, coro)
+
+        def done(task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        task.add_done_callback(done)
+
+    loop.call_soon_threadsafe(start)
+    return future
+
+
+def run(coro):
+    """
+    Run a coroutine on the worker's event loop and wait for its result, in place of asyncio.run
+    """
+    if in_loop():
+        coro.close()
+        raise RuntimeError("event_loop.run called from the event loop itself, await the coroutine instead")
+    return submit(coro).result()
+
+
+async def wait_for(awaitable):
+    # Tasks need a coroutine, and an async generator's steps are only awaitables
+    return await awaitable
+
+
+def iterate(async_generator):
+    """
+    Drive an async generator on the worker's event loop from synchronous code, such as a streamed Flask response
+    """
+    try:
+        while True:
+            try:
+                yield run(wait_for(async_generator.__anext__()))
+            except StopAsyncIteration:
+                break
+    finally:
+        run(wait_for(async_generator.aclose()))
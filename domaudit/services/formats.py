@@ -0,0 +1,51 @@
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from flask import Response
+
+# Columnar output formats, and the content type each is served with
+COLUMNAR_FORMATS = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.file",
+}
+
+
+def typed_array(values):
+    """
+    Returns an Arrow array for a column of python values, letting Arrow infer the type.
+    Columns mixing incompatible types fall back to JSON text so the export never fails.
+    """
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if v is None else json.dumps(v) for v in values], type=pa.string())
+
+
+def columns_to_table(columns):
+    """
+    Build an Arrow table from a dictionary of column name to values
+    """
+    return pa.table({name: typed_array(values) for name, values in columns.items()})
+
+
+def write_table(table, output_format):
+    """
+    Serialise a table to parquet or Arrow IPC file bytes
+    """
+    sink = pa.BufferOutputStream()
+    if output_format == "parquet":
+        pq.write_table(table, sink)
+    else:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def table_response(table, output_format, name):
+    """
+    Returns a Flask response downloading the table in a columnar format
+    """
+    return Response(write_table(table, output_format),
+                    mimetype=COLUMNAR_FORMATS[output_format],
+                    headers={"Content-Disposition": f"attachment; filename={name}.{output_format}"})
@@ -0,0 +1,192 @@
+import os
+import time
+import atexit
+import weakref
+import asyncio
+import logging
+import contextlib
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from aiohttp import ClientSession, ClientTimeout, ClientError, TCPConnector, TraceConfig, DummyCookieJar
+
+from domaudit.services import retry, metrics, event_loop
+
+# Connection pool settings, shared by the sync and async clients
+HTTP_POOL_SIZE = int(os.getenv("DOMAUDIT_HTTP_POOL_SIZE", 10))
+HTTP_POOL_PER_HOST = int(os.getenv("DOMAUDIT_HTTP_POOL_PER_HOST", 50))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("DOMAUDIT_HTTP_KEEPALIVE_SECONDS", 60))
+# Connections open at once across every audit in a worker, through its event loop's shared pool
+HTTP_ASYNC_POOL_SIZE = int(os.getenv("DOMAUDIT_HTTP_ASYNC_POOL_SIZE", 100))
+
+_session = None
+_session_pid = None
+_connector = None
+_connector_loop = None
+# The most calls each async session may have in flight, as the shared pool no longer caps them per session
+_session_slots = weakref.WeakKeyDictionary()
+
+
+def get_session():
+    """
+    Returns the pooled requests session for this worker process, creating it on first use.
+    The session is shared between users, so cookies are never stored on it.
+    """
+    global _session, _session_pid
+    # gunicorn forks workers, so never reuse a pool created in another process
+    if _session is None or _session_pid != os.getpid():
+        session = requests.Session()
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_PER_HOST)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        logging.info(f"Created HTTP connection pool: {HTTP_POOL_SIZE} host(s), {HTTP_POOL_PER_HOST} connection(s) per host")
+        _session = session
+        _session_pid = os.getpid()
+    return _session
+
+
+def get(url, headers=None, params=None, endpoint=None):
+    """
+    GET a url using the worker's pooled session.
+    Connection errors and retryable statuses are retried with backoff, and the circuit breaker
+    for the host is checked before every attempt. endpoint is the API endpoint template, used
+    to pick the timeout. Returns the last response once attempts run out.
+    """
+    breaker = retry.breaker_for(url)
+    timeout = retry.timeout_for(endpoint)
+    for attempt in range(retry.HTTP_RETRY_ATTEMPTS):
+        breaker.before_call()
+        last_attempt = attempt + 1 >= retry.HTTP_RETRY_ATTEMPTS
+        t = time.monotonic()
+        try:
+            response = get_session().get(url, headers=headers, params=params, timeout=timeout)
+        except requests.RequestException as e:
+            metrics.observe_upstream(endpoint, time.monotonic() - t, None)
+            breaker.record_failure()
+            if last_attempt:
+                raise retry.UpstreamError(None, endpoint or url, f"Domino API call to {endpoint or url} failed: {e}") from e
+            delay = retry.backoff_seconds(attempt)
+            logging.warning(f"GET {endpoint or url} failed: {e}. Retrying in {round(delay, 2)} seconds")
+        else:
+            metrics.observe_upstream(endpoint, time.monotonic() - t, response.status_code)
+            if response.status_code not in retry.RETRY_STATUSES:
+                breaker.record_success()
+                return response
+            breaker.record_failure()
+            if last_attempt:
+                return response
+            delay = retry.backoff_seconds(attempt, retry.retry_after_seconds(response.headers.get("Retry-After", None)))
+            logging.warning(f"GET {endpoint or url} returned {response.status_code}. Retrying in {round(delay, 2)} seconds")
+        time.sleep(delay)
+
+
+def call_trace(observers):
+    """
+    Returns an aiohttp trace config that reports every request to each observer,
+    as observer(elapsed_seconds, status). status is None if the request failed without a response.
+    """
+    trace = TraceConfig()
+
+    async def on_request_start(session, context, params):
+        context.start = time.monotonic()
+
+    async def on_request_end(session, context, params):
+        for observer in observers:
+            observer(time.monotonic() - context.start, params.response.status)
+
+    async def on_request_exception(session, context, params):
+        for observer in observers:
+            observer(time.monotonic() - context.start, None)
+
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    trace.on_request_exception.append(on_request_exception)
+    return trace
+
+
+def shared_connector():
+    """
+    Returns the connection pool of the worker's event loop, creating it on first use.
+    Every audit's session borrows it, so connections kept alive by one audit are reused by the next.
+    """
+    global _connector, _connector_loop
+    loop = asyncio.get_running_loop()
+    if _connector is None or _connector_loop is not loop or _connector.closed:
+        _connector = TCPConnector(limit=HTTP_ASYNC_POOL_SIZE,
+                                  limit_per_host=HTTP_POOL_PER_HOST,
+                                  keepalive_timeout=HTTP_KEEPALIVE_SECONDS)
+        _connector_loop = loop
+        logging.info(f"Created async HTTP connection pool: {HTTP_ASYNC_POOL_SIZE} connection(s), {HTTP_POOL_PER_HOST} per host")
+    return _connector
+
+
+def close_connector():
+    """
+    Close the worker's async connection pool, if it has one, when the worker exits
+    """
+    connector = _connector
+    if connector is not None and not connector.closed and _connector_loop.is_running():
+        event_loop.run(event_loop.wait_for(connector.close()))
+
+
+atexit.register(close_connector)
+
+
+def async_session(auth_header, threads, observers=()):
+    """
+    Returns an aiohttp session using the same pool settings as the sync client.
+    threads caps the number of calls this session has in flight at once.
+    observers are called with the latency and status of every request made with it.
+    On the worker's event loop the session borrows the shared pool, elsewhere it has a pool of its own.
+    """
+    trace_configs = [call_trace(observers)] if observers else None
+    if event_loop.in_loop():
+        session = ClientSession(connector=shared_connector(), connector_owner=False, headers=auth_header,
+                                cookie_jar=DummyCookieJar(), trace_configs=trace_configs)
+        _session_slots[session] = asyncio.Semaphore(threads)
+        return session
+    connector = TCPConnector(limit=threads,
+                             limit_per_host=min(threads, HTTP_POOL_PER_HOST),
+                             keepalive_timeout=HTTP_KEEPALIVE_SECONDS)
+    return ClientSession(connector=connector, headers=auth_header, cookie_jar=DummyCookieJar(),
+                         trace_configs=trace_configs)
+
+
+async def get_json_async(session, url, endpoint=None):
+    """
+    GET a url with an aiohttp session, retrying the same way as get.
+    Returns the status code, and the decoded JSON body for a 200 response or None otherwise.
+    """
+    breaker = retry.breaker_for(url)
+    timeout = ClientTimeout(total=retry.timeout_for(endpoint))
+    for attempt in range(retry.HTTP_RETRY_ATTEMPTS):
+        breaker.before_call()
+        last_attempt = attempt + 1 >= retry.HTTP_RETRY_ATTEMPTS
+        try:
+            async with _session_slots.get(session, None) or contextlib.nullcontext():
+                # Time the call itself, not the wait for a slot
+                t = time.monotonic()
+                async with session.get(url, timeout=timeout) as response:
+                    status = response.status
+                    retry_after = response.headers.get("Retry-After", None)
+                    data = await response.json() if status == 200 else None
+        except (ClientError, asyncio.TimeoutError) as e:
+            metrics.observe_upstream(endpoint, time.monotonic() - t, None)
+            breaker.record_failure()
+            if last_attempt:
+                raise retry.UpstreamError(None, endpoint or url, f"Domino API call to {endpoint or url} failed: {e!r}") from e
+            delay = retry.backoff_seconds(attempt)
+            logging.warning(f"GET {endpoint or url} failed: {e!r}. Retrying in {round(delay, 2)} seconds")
+        else:
+            metrics.observe_upstream(endpoint, time.monotonic() - t, status)
+            if status not in retry.RETRY_STATUSES:
+                breaker.record_success()
+                return status, data
+            breaker.record_failure()
+            if last_attempt:
+                return status, None
+            delay = retry.backoff_seconds(attempt, retry.retry_after_seconds(retry_after))
+            logging.warning(f"GET {endpoint or url} returned {status}. Retrying in {round(delay, 2)} seconds")
+        await asyncio.sleep(delay)
@@ -0,0 +1,84 @@
+import os
+import time
+from contextlib import contextmanager
+
+from flask import Response
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+                               REGISTRY, generate_latest, multiprocess)
+
+from domaudit.services import timing
+
+# In multiprocess mode every worker writes its metrics here, so it has to exist before any metric is created
+if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+# Audits take from milliseconds to many minutes, so the request buckets run much longer than the defaults
+REQUEST_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+UPSTREAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REQUEST_LATENCY = Histogram("domaudit_request_duration_seconds",
+                            "Time to build the response to a request. Streamed responses are timed to their first byte",
+                            ["route", "method", "status"], buckets=REQUEST_BUCKETS)
+UPSTREAM_LATENCY = Histogram("domaudit_upstream_request_duration_seconds",
+                             "Latency of calls to Domino and Keycloak, per endpoint template",
+                             ["endpoint"], buckets=UPSTREAM_BUCKETS)
+UPSTREAM_RESPONSES = Counter("domaudit_upstream_responses_total",
+                             "Calls to Domino and Keycloak by endpoint template and status. Status is error if no response was received",
+                             ["endpoint", "status"])
+ENRICHMENT_IN_FLIGHT = Gauge("domaudit_enrichment_in_flight",
+                             "Jobs being enriched right now", multiprocess_mode="livesum")
+CACHE_LOOKUPS = Counter("domaudit_cache_lookups_total",
+                        "Cache lookups by cache and result", ["cache", "result"])
+ROWS_EMITTED = Counter("domaudit_rows_emitted_total",
+                       "Report rows returned, per audit route", ["route"])
+SHARDS = Counter("domaudit_shards_total",
+                 "Shards of sharded audits by result: ok, retried on another replica, or enriched locally", ["result"])
+
+
+def observe_upstream(endpoint, elapsed, status):
+    """
+    Record one upstream call. status is None if no response was received.
+    The call is also added to the request's timing breakdown, if it has asked for one.
+    """
+    endpoint = endpoint or "other"
+    timing.record_call(endpoint, elapsed)
+    UPSTREAM_LATENCY.labels(endpoint).observe(elapsed)
+    UPSTREAM_RESPONSES.labels(endpoint, str(status) if status is not None else "error").inc()
+
+
+@contextmanager
+def upstream_call(endpoint):
+    """
+    Time a call made through a client that does not report statuses, such as python-keycloak.
+    Exceptions carrying a response_code are recorded with it.
+    """
+    t = time.monotonic()
+    try:
+        yield
+    except Exception as e:
+        observe_upstream(endpoint, time.monotonic() - t, getattr(e, "response_code", None))
+        raise
+    observe_upstream(endpoint, time.monotonic() - t, 200)
+
+
+def count_rows(route, rows):
+    """
+    Pass through an iterable of streamed rows, counting them as they are emitted
+    """
+    counter = ROWS_EMITTED.labels(route)
+    for row in rows:
+        counter.inc()
+        yield row
+
+
+def metrics_response():
+    """
+    Returns the metrics in the Prometheus text format. Under gunicorn, PROMETHEUS_MULTIPROC_DIR
+    is set and the metrics of every worker are merged.
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+# Attempts made for each call, including the first
+HTTP_RETRY_ATTEMPTS = int(os.getenv("DOMAUDIT_HTTP_RETRY_ATTEMPTS", 4))
+# Exponential backoff between attempts: a random delay up to base * 2^attempt, capped at max
+HTTP_BACKOFF_BASE_SECONDS = float(os.getenv("DOMAUDIT_HTTP_BACKOFF_BASE_SECONDS", 0.5))
+HTTP_BACKOFF_MAX_SECONDS = float(os.getenv("DOMAUDIT_HTTP_BACKOFF_MAX_SECONDS", 10))
+# Timeout for a single attempt, unless the endpoint has its own below
+HTTP_TIMEOUT_SECONDS = float(os.getenv("DOMAUDIT_HTTP_TIMEOUT_SECONDS", 30))
+# Per-endpoint timeouts as JSON, keyed by endpoint template, e.g. {"v4/activity": 120}
+HTTP_ENDPOINT_TIMEOUTS = {
+    "v4/jobs": 60,
+    "v4/activity": 60,
+    **json.loads(os.getenv("DOMAUDIT_HTTP_ENDPOINT_TIMEOUTS", "{}")),
+}
+# Consecutive failures that open the circuit to a host, and how long it stays open
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("DOMAUDIT_CIRCUIT_FAILURE_THRESHOLD", 20))
+CIRCUIT_RESET_SECONDS = float(os.getenv("DOMAUDIT_CIRCUIT_RESET_SECONDS", 30))
+
+# Responses worth retrying: rate limiting and an overloaded or restarting upstream
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class UpstreamError(Exception):
+    """
+    A Domino API call failed. status_code is None if no response was received.
+    """
+
+    def __init__(self, status_code, origin, message=None):
+        self.status_code = status_code
+        self.origin = origin
+        super().__init__(message or f"Domino API call failed in {origin}. Status code: {status_code}")
+
+
+class CircuitOpenError(UpstreamError):
+    """
+    A call was refused without being sent, because its host has been failing
+    """
+
+    def __init__(self, host, retry_after):
+        self.retry_after = retry_after
+        super().__init__(None, host, f"Domino API at {host} is unavailable, retry in {round(retry_after)} seconds")
+
+
+class CircuitBreaker:
+    """
+    Tracks consecutive failures to one host. Once failure_threshold calls in a row have failed,
+    calls are refused for reset_seconds. A single trial call is then let through, and its result
+    closes the circuit again or reopens it.
+    """
+
+    def __init__(self, host, failure_threshold, reset_seconds):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError if calls to the host should not be made right now
+        """
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_seconds - time.monotonic()
+            if remaining <= 0 and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(self.host, max(remaining, 0))
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logging.info(f"Circuit to {self.host} closed")
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_in_flight or (self.opened_at is None and self.failures >= self.failure_threshold > 0):
+                logging.warning(f"Circuit to {self.host} opened after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+    def stats(self):
+        return {
+            "state": "closed" if self.opened_at is None else "open",
+            "consecutive_failures": self.failures,
+            "rejected": self.rejected,
+        }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(url):
+    """
+    Returns the circuit breaker for the host of a url
+    """
+    host = urlsplit(url).netloc
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+        return _breakers[host]
+
+
+def breaker_stats():
+    return {host: breaker.stats() for host, breaker in _breakers.items()}
+
+
+def timeout_for(endpoint):
+    return HTTP_ENDPOINT_TIMEOUTS.get(endpoint, HTTP_TIMEOUT_SECONDS)
+
+
+def retry_after_seconds(value):
+    """
+    Returns the delay asked for by a Retry-After header, given in seconds or as an HTTP date
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_seconds(attempt, retry_after=None):
+    """
+    Returns how long to wait before the next attempt. Retry-After is honoured up to the backoff cap.
+    """
+    if retry_after is not None:
+        return min(retry_after, HTTP_BACKOFF_MAX_SECONDS)
+    return random.uniform(0, min(HTTP_BACKOFF_MAX_SECONDS, HTTP_BACKOFF_BASE_SECONDS * 2 ** attempt))
@@ -0,0 +1,90 @@
+import json
+
+import pyarrow as pa
+from flask import Response
+
+from domaudit.services import formats
+
+# Rows formatted and written at a time when streaming newline delimited JSON
+ROW_BUFFER_CHUNK_SIZE = 500
+
+
+class RowBuffer:
+    """
+    Append-only buffer of report rows, held as one list per column rather than a dictionary per row.
+    Rows keep the order they were appended in, and each has an ID that is unique within the buffer.
+    Timestamp columns hold epoch milliseconds until the buffer is written out, and are then
+    formatted in one pass by the function given for the column.
+    """
+
+    def __init__(self, columns, timestamp_columns=None):
+        self.columns = tuple(columns)
+        self.timestamp_columns = timestamp_columns or {}
+        self.ids = []
+        self._values = [[] for _ in self.columns]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, row, row_id=None):
+        """
+        Add a row, given as a dictionary of column name to value. Rows without an ID are numbered.
+        """
+        self.ids.append(len(self.ids) if row_id is None else row_id)
+        for name, values in zip(self.columns, self._values):
+            values.append(row.get(name, None))
+
+    def clear(self):
+        self.ids = []
+        self._values = [[] for _ in self.columns]
+
+    def formatted_columns(self):
+        return [self.timestamp_columns[name](values) if name in self.timestamp_columns else values
+                for name, values in zip(self.columns, self._values)]
+
+    def to_dict(self):
+        """
+        Returns the rows as a dictionary of row ID to row
+        """
+        return {row_id: dict(zip(self.columns, row)) for row_id, row in zip(self.ids, zip(*self.formatted_columns()))}
+
+    def to_json(self):
+        # json.dumps keeps the row order, where jsonify would sort the row IDs
+        return json.dumps(self.to_dict())
+
+    def to_ndjson(self):
+        """
+        Yield one line of JSON per row
+        """
+        for row in zip(*self.formatted_columns()):
+            yield json.dumps(dict(zip(self.columns, row))) + "\n"
+
+    def to_table(self):
+        """
+        Returns the rows as an Arrow table, with timestamp columns as UTC timestamps
+        """
+        return pa.table({name: pa.array(values, type=pa.timestamp("ms", tz="UTC"))
+                         if name in self.timestamp_columns else formats.typed_array(values)
+                         for name, values in zip(self.columns, self._values)})
+
+
+def stream_ndjson(rows, columns, timestamp_columns=None, chunk_size=ROW_BUFFER_CHUNK_SIZE):
+    """
+    Yield newline delimited JSON for an iterable of row dictionaries, formatting a chunk of rows at a time
+    """
+    buffer = RowBuffer(columns, timestamp_columns)
+    for row in rows:
+        buffer.append(row)
+        if len(buffer) >= chunk_size:
+            yield from buffer.to_ndjson()
+            buffer.clear()
+    yield from buffer.to_ndjson()
+
+
+def buffer_response(buffer, output_format, name):
+    """
+    Returns a Flask response holding the buffered rows as JSON, or as a columnar download
+    """
+    if output_format in formats.COLUMNAR_FORMATS:
+        return formats.table_response(buffer.to_table(), output_format, name)
+    return Response(buffer.to_json(), mimetype="application/json")
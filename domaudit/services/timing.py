@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import heapq
+import logging
+import contextvars
+from contextlib import contextmanager
+
+# Spans are emitted when OpenTelemetry is installed and configured, and cost nothing otherwise
+try:
+    from opentelemetry import trace
+    tracer = trace.get_tracer("domaudit")
+except ImportError:
+    tracer = None
+
+# Slowest jobs listed in a debug timing breakdown
+DEBUG_TIMING_SLOWEST_JOBS = int(os.getenv("DEBUG_TIMING_SLOWEST_JOBS", 10))
+SERVER_TIMING_HEADER = "Server-Timing"
+TIMING_HEADER = "X-Domaudit-Timing"
+
+_current = contextvars.ContextVar("domaudit_request_timer", default=None)
+
+
+def percentile(sorted_values, q):
+    """
+    Returns the nearest-rank percentile of an already sorted list
+    """
+    index = max(round(q / 100 * len(sorted_values) + 0.5) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+class RequestTimer:
+    """
+    Timing breakdown of one request, collected when it asks for debug_timing.
+    Phases are wall clock time spent in each stage of the request, and add up if a stage runs more than once.
+    Upstream calls are kept per endpoint template, and the slowest jobs to enrich are kept by ID.
+    """
+
+    def __init__(self, slowest_jobs=DEBUG_TIMING_SLOWEST_JOBS):
+        self.started_at = time.monotonic()
+        self.phases = {}
+        self.calls = {}
+        self.slowest_jobs = slowest_jobs
+        self._jobs = []
+
+    def add_phase(self, name, elapsed):
+        self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    def add_call(self, endpoint, elapsed):
+        self.calls.setdefault(endpoint or "other", []).append(elapsed)
+
+    def add_job(self, job_id, elapsed):
+        # A bounded min-heap, so only the slowest jobs are held however many are enriched
+        if len(self._jobs) < self.slowest_jobs:
+            heapq.heappush(self._jobs, (elapsed, job_id))
+        elif self._jobs and elapsed > self._jobs[0][0]:
+            heapq.heapreplace(self._jobs, (elapsed, job_id))
+
+    def summary(self):
+        upstream = {}
+        for endpoint, latencies in self.calls.items():
+            latencies = sorted(latencies)
+            upstream[endpoint] = {
+                "calls": len(latencies),
+                "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+                "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+                "max_ms": round(latencies[-1] * 1000, 1),
+            }
+        return {
+            "total_ms": round((time.monotonic() - self.started_at) * 1000, 1),
+            "phases_ms": {name: round(elapsed * 1000, 1) for name, elapsed in self.phases.items()},
+            "upstream": upstream,
+            "slowest_jobs": [{"job_id": job_id, "ms": round(elapsed * 1000, 1)}
+                             for elapsed, job_id in sorted(self._jobs, reverse=True)],
+        }
+
+    def server_timing(self):
+        """
+        Returns the phases as a Server-Timing header value, which browser dev tools can display
+        """
+        entries = [f"{name};dur={round(elapsed * 1000, 1)}" for name, elapsed in self.phases.items()]
+        entries.append(f"total;dur={round((time.monotonic() - self.started_at) * 1000, 1)}")
+        return ", ".join(entries)
+
+    def headers(self):
+        """
+        Response headers carrying the breakdown, for responses that are not streamed
+        """
+        return {SERVER_TIMING_HEADER: self.server_timing(), TIMING_HEADER: json.dumps(self.summary())}
+
+    def trailer(self):
+        """
+        The last line of a newline delimited JSON stream, which has sent its headers before the timings are known
+        """
+        return json.dumps({"timing": self.summary()}) + "\n"
+
+
+def start(enabled):
+    """
+    Begin timing the current request if enabled. Returns the timer, or None.
+    """
+    timer = RequestTimer() if enabled else None
+    _current.set(timer)
+    return timer
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def phase(name):
+    """
+    Time a stage of the current request, and wrap it in a span if OpenTelemetry is installed
+    """
+    timer = _current.get()
+    t = time.monotonic()
+    try:
+        if tracer is not None:
+            with tracer.start_as_current_span(f"domaudit.{name}"):
+                yield
+        else:
+            yield
+    finally:
+        if timer is not None:
+            timer.add_phase(name, time.monotonic() - t)
+
+
+def timed(name, iterable):
+    """
+    Yield from an iterable, counting the time spent waiting for each item towards a phase.
+    Used for streamed responses, where fetching and writing rows are interleaved.
+    """
+    timer = _current.get()
+    if timer is None:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    try:
+        while True:
+            t = time.monotonic()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                timer.add_phase(name, time.monotonic() - t)
+            yield item
+    finally:
+        # Close the source if the response is abandoned part way, as yield from would
+        if hasattr(iterator, "close"):
+            iterator.close()
+
+
+def record_call(endpoint, elapsed):
+    timer = _current.get()
+    if timer is not None:
+        timer.add_call(endpoint, elapsed)
+
+
+def record_job(job_id, elapsed):
+    timer = _current.get()
+    if timer is not None:
+        timer.add_job(job_id, elapsed)
+
+
+def with_trailer(lines, label):
+    """
+    Yield the lines of a newline delimited JSON stream, followed by the timing trailer if the request is being timed
+    """
+    timer = _current.get()
+    if timer is None:
+        return lines
+
+    def stream():
+        yield from lines
+        logging.info(f"{label} timing: {json.dumps(timer.summary())}")
+        yield timer.trailer()
+
+    return stream()
@@ -1,83 +1,164 @@
 import logging
-from keycloak import KeycloakAdmin
-from keycloak.keycloak_admin import KeycloakAdmin
 from keycloak.urls_patterns import URL_ADMIN_EVENTS
 from os import getenv
-from flask import jsonify
-from datetime import datetime
+from collections import deque
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from flask import jsonify, make_response, Response
+from datetime import datetime, timedelta
+from domaudit.user_audit.user_directory import user_directory
+from domaudit.services import formats, row_buffer, metrics, timing
 
 
 logger = logging.getLogger(__name__)
 
+DATE_FORMAT = "%Y-%m-%d"
+# Number of day windows fetched from Keycloak in parallel
+USER_AUDIT_WINDOW_CONCURRENCY = int(getenv("USER_AUDIT_WINDOW_CONCURRENCY", 4))
+EVENT_COLUMNS = ("time", "type", "keycloakUserId", "ipAddress", "username", "email")
+OUTPUT_FORMATS = ("json", "ndjson", *formats.COLUMNAR_FORMATS)
+
 # Get Keycloak user event data, using env variables for login
 # Parameters:
 #   username: Optional Domino username to filter for audits
 #   dateFrom/dateTo: Optional date filters (yyyy-MM-dd format)
 #   type: Optional event type(s) filter
+#   refresh_users: Optional, true to reload the cached Keycloak user directory first
+#   debug_timing: Optional, true to return a breakdown of where the request spent its time
+#   format: Optional output format, json (default), ndjson to stream rows as they are fetched,
+#           or parquet/arrow for typed columnar files
 
 # TODO: Capture downstream KC errors and return them via api response
 # TODO: Allow filter by email
 
 def get_user_events(data=None):
 
-    keycloak_server = f'http://{getenv("KEYCLOAK_HOST")}/auth/'
-    keycloak_user = getenv("KEYCLOAK_USERNAME","keycloak")
-    keycloak_pwd = getenv("KEYCLOAK_PASSWORD")
     if data:
         args = dict(data)
     else:
         args = dict()
-    
-    logging.info(f"Connecting to keycloak at {keycloak_server}, parameters: {args}")
-    
-    keycloak_admin = KeycloakAdmin(                            
-                            server_url=keycloak_server,
-                            username=keycloak_user,
-                            password=keycloak_pwd,
-                            realm_name="DominoRealm",
-                            user_realm_name="master",
-                            verify=True,
-                            timeout=300)
-
-    users_list = keycloak_admin.get_users()
-    all_users = dict()
-    for user in users_list:
-        all_users[user['id']] = {"username" : user.get('username', None), "email" : user.get('email', None)}
+    output_format = args.pop("format", "json").lower()
+    if output_format not in OUTPUT_FORMATS:
+        error = {
+            "message": f"Unsupported format: {output_format}. Valid values: {', '.join(OUTPUT_FORMATS)}"
+        }
+        return make_response(error, 400)
+    refresh_users = args.pop("refresh_users", "False").lower() == "true"
+    # Read by the app before the request reaches here, and not a Keycloak filter
+    args.pop("debug_timing", None)
+
+    logging.info(f"Fetching keycloak events, parameters: {args}")
+
+    with timing.phase("user_directory"):
+        user_directory.ensure_fresh(force=refresh_users)
+    keycloak_admin = user_directory.admin()
 
     if 'username' in args:
-        for user in users_list:
-            if user.get('username',None) == args['username']:
-                del args['username']
-                args["user"] = user['id']
-                break
+        user = user_directory.find_username(args['username'])
+        if user:
+            del args['username']
+            args["user"] = user['id']
     
     path = {"realm-name": keycloak_admin.realm_name}
+    url = URL_ADMIN_EVENTS.format(**path)
     if 'first' in args and 'max' in args:
-        events = keycloak_admin._KeycloakAdmin__fetch_paginated(URL_ADMIN_EVENTS.format(**path),args)
+        with timing.phase("events"), metrics.upstream_call("keycloak/events"):
+            events = keycloak_admin._KeycloakAdmin__fetch_paginated(url,args)
+    elif 'dateFrom' in args:
+        events = fetch_events_by_window(keycloak_admin, url, args)
     else:
-        events = keycloak_admin._KeycloakAdmin__fetch_all(URL_ADMIN_EVENTS.format(**path),args)
-
-    response = {}
-    for event in events:
-        time = event.get("time", None)
-        response[time] = {}
-        clean_time = datetime.utcfromtimestamp(
-                event.get("time", 0)/1000.0
-            ).strftime(
-                '%Y-%m-%d %H:%M:%S.%f'
-            )
-        if 'userId' in event:
-            user = all_users.get(event.get("userId" ,None))
-        else:
-            user = None
-        response[time]["time"] = clean_time,
-        response[time]["type"] = event.get("type", None),
-        response[time]["keycloakUserId"] = event.get('userId',None),
-        response[time]["ipAddress"] = event.get("ipAddress", None),
-        response[time]["username"] = user.get("username", None) if user else "",
-        response[time]["email"] = user.get("email", None) if user else ""
-
-    return response
+        with timing.phase("events"), metrics.upstream_call("keycloak/events"):
+            events = keycloak_admin._KeycloakAdmin__fetch_all(url,args)
+
+    rows = metrics.count_rows("/user_audit", (transform_event(event) for event in events))
+    if output_format == "ndjson":
+        return Response(timing.with_trailer(row_buffer.stream_ndjson(rows, EVENT_COLUMNS, EVENT_TIMESTAMP_COLUMNS), "/user_audit"),
+                        mimetype="application/x-ndjson")
+
+    # Keycloak events have no ID, so rows are numbered in the order they were fetched
+    # rather than keyed by time, where events in the same millisecond would overwrite each other
+    output = row_buffer.RowBuffer(EVENT_COLUMNS, EVENT_TIMESTAMP_COLUMNS)
+    # Windowed fetches are lazy, so this covers fetching the events as well as building the rows
+    with timing.phase("events"):
+        for row in rows:
+            output.append(row)
+    with timing.phase("serialisation"):
+        return row_buffer.buffer_response(output, output_format, "user-audit")
+
+
+def format_event_times(epoch_ms):
+    """
+    Format epoch millisecond event times as UTC yyyy-MM-dd HH:mm:ss.ffffff, without a strftime call per value.
+    Events without a time are left as None.
+    """
+    values = np.array(epoch_ms, dtype="datetime64[ms]").astype("datetime64[us]")
+    return [None if s == "NaT" else f"{s[:10]} {s[11:]}" for s in np.datetime_as_string(values, unit="us")]
+
+
+# Event times stay as epoch milliseconds in the row buffer, and are formatted when it is written out
+EVENT_TIMESTAMP_COLUMNS = {"time": format_event_times}
+
+
+def transform_event(event):
+    """
+    Returns the report row for a single Keycloak event. The time is left in epoch milliseconds.
+    """
+    if 'userId' in event:
+        user = user_directory.get(event.get("userId" ,None))
+    else:
+        user = None
+    return {
+        "time": event.get("time", None),
+        "type": event.get("type", None),
+        "keycloakUserId": event.get('userId',None),
+        "ipAddress": event.get("ipAddress", None),
+        "username": user.get("username", None) if user else "",
+        "email": user.get("email", None) if user else ""
+    }
+
+
+def date_windows(date_from, date_to):
+    """
+    Split an inclusive yyyy-MM-dd date range into one day windows
+    """
+    day = datetime.strptime(date_from, DATE_FORMAT).date()
+    last_day = datetime.strptime(date_to, DATE_FORMAT).date() if date_to else datetime.utcnow().date()
+    while day <= last_day:
+        yield day.strftime(DATE_FORMAT)
+        day += timedelta(days=1)
+
+
+def fetch_window(keycloak_admin, url, args, day):
+    """
+    Fetch every event from a single day, oldest first
+    """
+    query = dict(args)
+    query["dateFrom"] = day
+    query["dateTo"] = day
+    with metrics.upstream_call("keycloak/events"):
+        events = keycloak_admin._KeycloakAdmin__fetch_all(url, query)
+    events.sort(key=lambda event: event.get("time", 0))
+    return events
+
+
+def fetch_events_by_window(keycloak_admin, url, args):
+    """
+    Yield events between dateFrom and dateTo in time order.
+    Each day is fetched separately, with at most USER_AUDIT_WINDOW_CONCURRENCY days in flight,
+    so neither the service nor Keycloak holds the whole range at once.
+    """
+    windows = date_windows(args["dateFrom"], args.get("dateTo", None))
+    with ThreadPoolExecutor(max_workers=USER_AUDIT_WINDOW_CONCURRENCY) as executor:
+        in_flight = deque()
+        for day in windows:
+            # Run in a copy of the request's context, so the calls are included in its timing breakdown
+            in_flight.append(executor.submit(contextvars.copy_context().run, fetch_window, keycloak_admin, url, args, day))
+            if len(in_flight) >= USER_AUDIT_WINDOW_CONCURRENCY:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
+
 
 if __name__ == "__main__":
     get_user_events()
@@ -0,0 +1,143 @@
+import logging
+import os
+import threading
+import time
+from os import getenv
+
+from keycloak.keycloak_admin import KeycloakAdmin
+
+from domaudit.services import cache, metrics
+
+# Seconds before the user directory is considered stale and reloaded on request
+USER_DIRECTORY_TTL_SECONDS = float(getenv("USER_DIRECTORY_TTL_SECONDS", 900))
+# Seconds between background reloads of the user directory. 0 disables background reloads
+USER_DIRECTORY_REFRESH_SECONDS = float(getenv("USER_DIRECTORY_REFRESH_SECONDS", 300))
+
+
+class UserDirectory:
+    """
+    Process wide directory of Keycloak users, indexed by id and username.
+    The KeycloakAdmin session is shared by every request, and python-keycloak refreshes its token as needed.
+    """
+
+    def __init__(self, ttl, refresh_interval):
+        self.name = "keycloak_users"
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._admin = None
+        self._by_id = {}
+        self._by_username = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._refresher_pid = None
+        cache.CACHES[self.name] = self
+
+    def admin(self):
+        """
+        Returns the shared KeycloakAdmin, logging in on first use
+        """
+        if self._admin is None:
+            keycloak_server = f'http://{getenv("KEYCLOAK_HOST")}/auth/'
+            logging.info(f"Connecting to keycloak at {keycloak_server}")
+            self._admin = KeycloakAdmin(
+                                server_url=keycloak_server,
+                                username=getenv("KEYCLOAK_USERNAME","keycloak"),
+                                password=getenv("KEYCLOAK_PASSWORD"),
+                                realm_name="DominoRealm",
+                                user_realm_name="master",
+                                verify=True,
+                                timeout=300)
+        return self._admin
+
+    def refresh(self):
+        """
+        Reload every user from Keycloak
+        """
+        t = time.monotonic()
+        try:
+            with metrics.upstream_call("keycloak/users"):
+                users_list = self.admin().get_users()
+        except Exception:
+            # Log in again next time, in case the session could not be refreshed
+            self._admin = None
+            raise
+        by_id = {}
+        by_username = {}
+        for user in users_list:
+            entry = {"id": user['id'], "username": user.get('username', None), "email": user.get('email', None)}
+            by_id[user['id']] = entry
+            if entry["username"]:
+                by_username[entry["username"]] = entry
+        self._by_id = by_id
+        self._by_username = by_username
+        self._loaded_at = time.monotonic()
+        self.refreshes += 1
+        logging.info(f"Loaded {len(by_id)} Keycloak users in {round(time.monotonic() - t, 1)} seconds")
+
+    def ensure_fresh(self, force=False):
+        """
+        Reload the directory if it is forced, empty or older than the TTL
+        """
+        self._start_background_refresh()
+        if not force and self._is_fresh():
+            self.hits += 1
+            metrics.CACHE_LOOKUPS.labels(self.name, "hit").inc()
+            return
+        with self._lock:
+            # Another request may have reloaded the directory while we waited
+            if not force and self._is_fresh():
+                self.hits += 1
+                metrics.CACHE_LOOKUPS.labels(self.name, "hit").inc()
+                return
+            self.misses += 1
+            metrics.CACHE_LOOKUPS.labels(self.name, "miss").inc()
+            self.refresh()
+
+    def invalidate(self, key=None):
+        """
+        Mark the directory stale, so the next request reloads it
+        """
+        self._loaded_at = None
+
+    def _is_fresh(self):
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at <= self.ttl
+
+    def get(self, user_id):
+        return self._by_id.get(user_id, None)
+
+    def find_username(self, username):
+        return self._by_username.get(username, None)
+
+    def _start_background_refresh(self):
+        # gunicorn forks workers, so each process starts its own refresher
+        if self.refresh_interval <= 0 or self._refresher_pid == os.getpid():
+            return
+        self._refresher_pid = os.getpid()
+        threading.Thread(target=self._refresh_forever, name="user-directory-refresh", daemon=True).start()
+
+    def _refresh_forever(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                with self._lock:
+                    self.refresh()
+            except Exception as e:
+                logging.warning(f"Background refresh of Keycloak users failed: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._by_id),
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "age_seconds": round(time.monotonic() - self._loaded_at, 1) if self._loaded_at else None,
+        }
+
+
+user_directory = UserDirectory(USER_DIRECTORY_TTL_SECONDS, USER_DIRECTORY_REFRESH_SECONDS)
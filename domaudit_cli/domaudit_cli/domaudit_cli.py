@@ -1,3 +1,4 @@
+import json
 import requests
 from os import getenv, path
 import sys
@@ -10,13 +11,11 @@ DOMAUDIT_HOST = getenv("DOMAUDIT_HOST",f"http://domaudit.{DOM_NAMESPACE}")
 USER_AUDIT_PATH = "/user_audit"
 PROJECT_AUDIT_PATH = "/project_audit"
 PROJECT_ACTIVITY_PATH = "/project_activity"
-
-def get_project_id(project_owner, project_name):
-
-    project = make_call(f"{getenv('DOMINO_API_HOST')}/v4/gateway/projects/findProjectByOwnerAndName",
-              {"ownerName": project_owner, "projectName": project_name} )
-    
-    return project['id']
+PROJECT_AUDIT_BATCH_PATH = "/project_audit_batch"
+AUDIT_JOBS_PATH = "/audit_jobs"
+# Output types written by the service itself, rather than converted locally by pandas
+COLUMNAR_OUTPUT_TYPES = ["parquet", "arrow"]
+CURSOR_HEADER = "X-Domaudit-Cursor"
 
 def make_call(host,parameters=None):
 
@@ -28,6 +27,111 @@ def make_call(host,parameters=None):
         print(f"Error when making request : {response.text}")
         raise Exception(response.text)
 
+def make_paged_call(host, parameters=None):
+    """
+    Call an endpoint that returns a resume cursor, following cursors until the report is complete
+    """
+    headers = {"X-Domino-Api-Key": getenv("DOMINO_USER_API_KEY")}
+    parameters = dict(parameters or {})
+    output = {}
+    while True:
+        response = requests.get(host, params=parameters, headers=headers)
+        if response.status_code != 200:
+            print(f"Error when making request : {response.text}")
+            raise Exception(response.text)
+        output.update(response.json())
+        cursor = response.headers.get(CURSOR_HEADER, None)
+        if not cursor:
+            return output
+        parameters["cursor"] = cursor
+
+def make_streamed_call(host, parameters=None):
+    """
+    Call an endpoint that streams newline delimited JSON, keying rows by their Job ID.
+    Prints the summary line the batch audit ends with.
+    """
+    headers = {"X-Domino-Api-Key": getenv("DOMINO_USER_API_KEY")}
+    output = {}
+    with requests.get(host, params=parameters, headers=headers, stream=True) as response:
+        if response.status_code != 200:
+            print(f"Error when making request : {response.text}")
+            raise Exception(response.text)
+        for line in response.iter_lines():
+            if not line:
+                continue
+            row = json.loads(line)
+            if "summary" in row:
+                summary = row["summary"]
+                print(f"Audited {summary['jobs']} jobs from {summary['projects_requested']} projects")
+                for failed in summary["failed_projects"]:
+                    print(f"Skipped project {failed['project']} : {failed['error']}")
+            else:
+                output[row["Job ID"]] = row
+    return output
+
+def download_file(prefix, host, parameters, path, output):
+    """
+    Request a columnar format from the service and write the response straight to disk.
+    Reports that return a resume cursor are followed to the end, writing each part to its own numbered file.
+    """
+    timestr = time.strftime("%Y%m%d-%H%M%S")
+    headers = {"X-Domino-Api-Key": getenv("DOMINO_USER_API_KEY")}
+    parameters = dict(parameters, format=output) if parameters else None
+    part = 1
+    while True:
+        filename = f"{prefix}-{timestr}.{output}" if part == 1 else f"{prefix}-{timestr}-part{part}.{output}"
+        with requests.get(host, params=parameters, headers=headers, stream=True) as response:
+            if response.status_code != 200:
+                print(f"Error when making request : {response.text}")
+                raise Exception(response.text)
+            with open(f"{path}/{filename}", "wb") as f:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+            cursor = response.headers.get(CURSOR_HEADER, None)
+
+        print(f"{prefix} Output written to {path}/{filename}")
+        if not cursor or parameters is None:
+            return
+        parameters["cursor"] = cursor
+        part += 1
+
+def submit_and_wait(prefix, host, parameters, path, output, poll_interval):
+    """
+    Submit an audit as a background job on the service, poll until it finishes, then download the result.
+    The connection is never held open for the whole audit, so long audits survive ingress timeouts.
+    """
+    headers = {"X-Domino-Api-Key": getenv("DOMINO_USER_API_KEY")}
+    result_format = output if output in COLUMNAR_OUTPUT_TYPES else "json"
+    response = requests.post(f"{host}{AUDIT_JOBS_PATH}", json=dict(parameters, format=result_format), headers=headers)
+    if response.status_code != 202:
+        print(f"Error when submitting audit : {response.text}")
+        raise Exception(response.text)
+    job = response.json()
+    print(f"Submitted background audit {job['id']}")
+
+    while job["status"] not in ("succeeded", "failed"):
+        time.sleep(poll_interval)
+        response = requests.get(f"{host}{job['status_url']}", headers=headers)
+        if response.status_code != 200:
+            print(f"Error when polling audit : {response.text}")
+            raise Exception(response.text)
+        job = dict(job, **response.json())
+        progress = job.get("progress", {})
+        print(f"Audit {job['status']}: {progress.get('jobs_enriched', 0)} of {progress.get('jobs_listed', '?')} jobs enriched")
+
+    if job["status"] == "failed":
+        print(f"Audit failed : {job.get('error', None)}")
+        raise Exception(job.get("error", None))
+
+    if output in COLUMNAR_OUTPUT_TYPES:
+        download_file(prefix, f"{host}{job['result_url']}", {}, path, output)
+    else:
+        response = requests.get(f"{host}{job['result_url']}", headers=headers)
+        if response.status_code != 200:
+            print(f"Error when downloading audit : {response.text}")
+            raise Exception(response.text)
+        write_file(prefix, response.json(), path, output)
+
 def write_file(prefix, data, path, output):
     timestr = time.strftime("%Y%m%d-%H%M%S")
     df = pd.DataFrame.from_dict(data, orient='index')
@@ -48,7 +152,7 @@ def cli():
                         description='Field solution for extending Domino Audit capabilities')
 
     parser.add_argument("--host", help=f"Domaudit service host - optional, defaults to {DOMAUDIT_HOST}", default=DOMAUDIT_HOST)
-    parser.add_argument("--output-type", help=f"Output Type. Defaults to csv, options are : csv, excel, json", default="csv")
+    parser.add_argument("--output-type", help=f"Output Type. Defaults to csv, options are : csv, excel, json, parquet, arrow", default="csv")
     parser.add_argument("--output-path", help=f"Output path. Defaults to local directory", default="./")
 
 
@@ -67,13 +171,38 @@ def cli():
     project_parser.add_argument("--links", action=argparse.BooleanOptionalAction, help="Include links back to Domino", default=False)
     project_parser.add_argument("--page-size", help="Page size of returned jobs, default 1000", default=1000)
     project_parser.add_argument("--page-number", help="Page number to return, default 1", default=1)
+    project_parser.add_argument("--all-pages", action=argparse.BooleanOptionalAction, 
+                                help="Return every page of jobs, starting from --page-number", default=False)
     project_parser.add_argument("--thread-count", help="Number of parallel API threads, default 10", default=10)
+    project_parser.add_argument("--incremental", action=argparse.BooleanOptionalAction, 
+                                help="Only fetch jobs that are new or still running since the last incremental audit", default=False)
+    project_parser.add_argument("--background", action=argparse.BooleanOptionalAction,
+                                help="Submit the audit as a background job on the service and wait for it to finish. "
+                                "Use for audits too long to hold a connection open", default=False)
+    project_parser.add_argument("--poll-interval", help="Seconds between status checks in --background mode, default 5",
+                                type=float, default=5)
+    project_parser.add_argument("--fields", help="Comma separated report columns to return, such as \"Username,Execution Status\". "
+                                "Only the Domino APIs those columns need are called. Default is every column")
+    project_parser.add_argument("--status", help="Only audit jobs with these comma separated execution statuses")
+    project_parser.add_argument("--user", help="Only audit jobs started by these comma separated usernames")
+    project_parser.add_argument("--from-date", help="Only audit jobs submitted on or after this date - YYYY-MM-DD format")
+    project_parser.add_argument("--to-date", help="Only audit jobs submitted on or before this date - YYYY-MM-DD format")
+
+    batch_parser = subparsers.add_parser(name="batch", help="Project Audit of many projects at once, with a project column")
+    batch_parser.add_argument("--projects", help="Comma separated Domino Projects to audit, each in the format OWNER/PROJECT")
+    batch_parser.add_argument("--owner", help="Audit every project owned by this user that you can see")
+    batch_parser.add_argument("--links", action=argparse.BooleanOptionalAction, help="Include links back to Domino", default=False)
+    batch_parser.add_argument("--page-size", help="Page size used when listing each project's jobs, default 1000", default=1000)
+    batch_parser.add_argument("--thread-count", help="Number of parallel API threads shared by all projects, default 10", default=10)
 
     activity_parser = subparsers.add_parser(name="activity", help="Project Activity")
     activity_parser.add_argument("--project", help="Domino Project to audit, in the format OWNER/PROJECT", 
                                 default="/".join([getenv("DOMINO_PROJECT_OWNER"),getenv("DOMINO_PROJECT_NAME")]))
     activity_parser.add_argument("--page-size", help="Maximum number of rows returned. Default is 500", default="500")
     activity_parser.add_argument("--latest-event-time", help="End date of the activity report - YYYY-MM-DD format")
+    activity_parser.add_argument("--from-date", help="Start date of the activity report - YYYY-MM-DD format. "
+                                 "Pages back through all activity until this date", dest="from_date")
+    activity_parser.add_argument("--max-pages", help="Maximum pages fetched per request when using --from-date", default=100)
     activity_parser.add_argument("--activity-source", help="Filter by activity source. Valid values: \n\t"
                                 "project, job, model_api, schedule_job, files, workspace, comment, app")
 
@@ -86,7 +215,7 @@ def cli():
     output_type = args.output_type
     output_path = args.output_path
 
-    if output_type not in ["csv","json","excel"]:
+    if output_type not in ["csv","json","excel"] + COLUMNAR_OUTPUT_TYPES:
         print(f"Invalid Output type: {output_type}")
         parser.print_help()
         exit(1)
@@ -102,51 +231,85 @@ def cli():
     clean_args.pop("output_path")
 
     if args.audit == "user":
-        output = make_call(f"{DOMAUDIT_HOST}{USER_AUDIT_PATH}",clean_args)
+        url, call_args = f"{DOMAUDIT_HOST}{USER_AUDIT_PATH}", clean_args
     elif args.audit == "project":
         split_string = args.project.split("/")
         if len(split_string)==2:
             project_owner = split_string[0]
             project_name = split_string[1]
-            project_id = get_project_id(project_owner,project_name)
             links = args.links
         else:
             print(f"Invalid project name format: {args.project}")
             project_parser.print_help()
             exit(1)
 
+        # The service looks up the project ID from its owner and name
         project_args = {
-            "project_id": project_id,
             "project_name": project_name,
             "project_owner": project_owner,
             "links": links,
             "page_size": args.page_size,
             "page_number": args.page_number,
+            "all_pages": args.all_pages,
+            "thread_count": args.thread_count,
+            "incremental": args.incremental
+        }
+        # Projection and filters are only sent when given, so background jobs never receive empty values
+        project_args.update({name: value for name, value in {"fields": args.fields, "status": args.status, "user": args.user,
+                                                             "from_date": args.from_date, "to_date": args.to_date}.items() if value})
+        url, call_args = f"{DOMAUDIT_HOST}{PROJECT_AUDIT_PATH}", project_args
+    elif args.audit == "batch":
+        if not args.projects and not args.owner:
+            print("Either --projects or --owner is required")
+            batch_parser.print_help()
+            exit(1)
+        if output_type in COLUMNAR_OUTPUT_TYPES:
+            print(f"Output type {output_type} is not supported for batch audits. Use csv, json or excel")
+            exit(1)
+        batch_args = {
+            "projects": args.projects,
+            "owner": args.owner,
+            "links": args.links,
+            "page_size": args.page_size,
             "thread_count": args.thread_count
         }
-        output = make_call(f"{DOMAUDIT_HOST}{PROJECT_AUDIT_PATH}",project_args)
+        url, call_args = f"{DOMAUDIT_HOST}{PROJECT_AUDIT_BATCH_PATH}", batch_args
     elif args.audit == "activity":
         split_string = args.project.split("/")
         if len(split_string)==2:
             project_owner = split_string[0]
             project_name = split_string[1]
-            project_id = get_project_id(project_owner,project_name)
         else:
             print(f"Invalid project name format: {args.project}")
             activity_parser.print_help()
             exit(1)
 
         activity_args = {
-            "project_id": project_id,
+            "project_name": project_name,
+            "project_owner": project_owner,
             "page_size": args.page_size,
             "latest_event_time": args.latest_event_time,
-            "activity_source": args.activity_source
+            "activity_source": args.activity_source,
+            "from_date": args.from_date,
+            "max_pages": args.max_pages
         }
-        print(f"*** Only returning the first {args.page_size} activities by date descending ***")
-        output = make_call(f"{DOMAUDIT_HOST}{PROJECT_ACTIVITY_PATH}",activity_args)
-
+        if not args.from_date:
+            print(f"*** Only returning the first {args.page_size} activities by date descending ***")
+        url, call_args = f"{DOMAUDIT_HOST}{PROJECT_ACTIVITY_PATH}", activity_args
 
-    write_file(args.audit, output, output_path, output_type)
+    if args.audit == "project" and args.background:
+        submit_and_wait(args.audit, DOMAUDIT_HOST, call_args, output_path, output_type, args.poll_interval)
+    elif output_type in COLUMNAR_OUTPUT_TYPES:
+        download_file(args.audit, url, call_args, output_path, output_type)
+    elif args.audit == "batch":
+        output = make_streamed_call(url, call_args)
+        write_file(args.audit, output, output_path, output_type)
+    elif args.audit == "activity" and args.from_date:
+        output = make_paged_call(url, call_args)
+        write_file(args.audit, output, output_path, output_type)
+    else:
+        output = make_call(url, call_args)
+        write_file(args.audit, output, output_path, output_type)
 
 
 if __name__ == "__main__":
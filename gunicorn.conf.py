@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# config reference at https://github.com/benoitc/gunicorn/blob/master/examples/example_config.py
+#
+# Workers are gthread workers. Each serves requests from a pool of threads, and schedules the
+# async work of every request on one long-lived asyncio event loop of its own, started on first use
+# by domaudit.services.event_loop, so concurrent audits share its connections.
+import os
+import shutil
+
+
+# start each run with empty prometheus metrics, shared between the worker processes
+def on_starting(server):
+    metrics_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir, exist_ok=True)
+
+
+# drop the live gauges of workers that have exited
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)